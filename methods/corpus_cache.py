@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Compiles a directory of midi files into a single binary corpus file, which is
+memory-mapped when loaded so training can start without parsing any midi
+"""
+
+from midi_events import readMidiFile
+import rhythm_melody as rm
+import midi
+import numpy as np
+import tempfile
+import hashlib
+import shutil
+import struct
+import json
+import os
+
+# The file starts with a fixed header of the magic bytes, the format version
+# and the position and length of the JSON metadata, which follows the arrays.
+# Arrays are stored raw, each starting on a 64 byte boundary.
+cacheMagic = b'MLMCORP\x00'
+cacheVersion = 1
+headerFormat = '<8sIxxxxQQ'
+arrayAlignment = 64
+defaultCacheName = 'corpus-track{}.cache'
+
+# Each track number has its own default cache, so alternating between them
+# does not rebuild the cache every time
+def defaultCachePath(path, trackNum=0):
+    return os.path.join(path, defaultCacheName.format(trackNum))
+
+# Returns the names of the midi files in a directory, in sorted order. Every
+# way of reading a directory of midi files uses this order, so a corpus is
+# the same whether or not it is cached.
+def sourceFiles(path):
+    return sorted(m for m in os.listdir(path)
+                  if os.path.isfile(os.path.join(path, m)) and m[-4:]=='.mid')
+
+# Describes each source file by its name, size and modification time
+def sourceMetadata(path, names):
+    sources = []
+    for name in names:
+        stat = os.stat(os.path.join(path, name))
+        sources.append({'name': name, 'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+    return sources
+
+# Hashes everything the compiled corpus depends on, so a changed, added or
+# removed source file gives a different hash
+def inputHash(sources, trackNum):
+    description = json.dumps({'version': cacheVersion, 'trackNum': trackNum,
+                              'sources': sources}, sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+# Returns the corpus compiled from a directory of midi files, loading it from
+# cachePath if that was compiled from the directory's current contents and
+# otherwise compiling it and saving it there first
+def loadOrBuildCorpus(path, cachePath=None, trackNum=0):
+    if cachePath is None:
+        cachePath = defaultCachePath(path, trackNum)
+    sources = sourceMetadata(path, sourceFiles(path))
+    expectedHash = inputHash(sources, trackNum)
+    corpus = loadCorpusCache(cachePath, expectedHash)
+    if corpus is None:
+        buildCorpusCache(path, cachePath, sources, expectedHash, trackNum)
+        corpus = loadCorpusCache(cachePath, expectedHash)
+    return corpus
+
+# Parses the given track of each source file and writes the resulting corpus
+# to cachePath, replacing it only once complete
+def buildCorpusCache(path, cachePath, sources, hashValue, trackNum=0):
+    cacheDirectory = os.path.dirname(os.path.abspath(cachePath))
+    with tempfile.TemporaryDirectory(dir=cacheDirectory) as scratch:
+        corpus = rm.TrackCorpus(scratch)
+        corpus.addStream(midi.makeTrackFromMidi(readMidiFile(os.path.join(path, source['name'])),
+                                                trackNum)
+                         for source in sources)
+        corpus.finish()
+        arrays = [(name, corpus.fieldPath(name), dtype, len(getattr(corpus, name)))
+                  for (name, dtype) in rm.TrackCorpus.fields]
+        # The mapped field arrays must be released before the scratch
+        # directory is removed
+        del corpus.rhythms, corpus.pitches, corpus.newNotes
+        with open(cachePath + '.tmp', 'wb') as file:
+            file.write(b'\x00' * struct.calcsize(headerFormat))
+            layout = {}
+            for (name, fieldPath, dtype, length) in arrays:
+                layout[name] = alignedWrite(file, dtype, length)
+                with open(fieldPath, 'rb') as field:
+                    shutil.copyfileobj(field, file)
+            for (name, array) in (('trackOffsets', corpus.trackOffsets),
+                                  ('barLens', corpus.barLens)):
+                layout[name] = alignedWrite(file, array.dtype, len(array))
+                file.write(array.tobytes())
+            metadata = json.dumps({'inputHash': hashValue,
+                                   'trackNum': trackNum,
+                                   'arrays': layout,
+                                   'sources': sources}).encode('utf-8')
+            metadataOffset = file.tell()
+            file.write(metadata)
+            file.seek(0)
+            file.write(struct.pack(headerFormat, cacheMagic, cacheVersion,
+                                   metadataOffset, len(metadata)))
+    os.replace(cachePath + '.tmp', cachePath)
+
+# Pads the file to the next array boundary and returns the layout entry of an
+# array about to be written there
+def alignedWrite(file, dtype, length):
+    offset = -(-file.tell() // arrayAlignment) * arrayAlignment
+    file.write(b'\x00' * (offset - file.tell()))
+    return {'offset': offset, 'dtype': np.dtype(dtype).str, 'length': int(length)}
+
+# Returns the metadata stored in a corpus cache, or None if the file is
+# missing or not a corpus cache of the current version
+def readCacheMetadata(cachePath):
+    try:
+        with open(cachePath, 'rb') as file:
+            header = file.read(struct.calcsize(headerFormat))
+            if len(header) < struct.calcsize(headerFormat):
+                return None
+            (magic, version, metadataOffset, metadataLength) = struct.unpack(headerFormat, header)
+            if magic != cacheMagic or version != cacheVersion:
+                return None
+            file.seek(metadataOffset)
+            return json.loads(file.read(metadataLength).decode('utf-8'))
+    except (OSError, ValueError):
+        return None
+
+# Maps a corpus cache into a finished TrackCorpus, returning None if the
+# cache is missing, invalid, or was not compiled from inputs with the
+# expected hash
+def loadCorpusCache(cachePath, expectedHash=None):
+    metadata = readCacheMetadata(cachePath)
+    if metadata is None:
+        return None
+    if not expectedHash is None and metadata['inputHash'] != expectedHash:
+        return None
+    arrays = {}
+    for (name, layout) in metadata['arrays'].items():
+        if layout['length'] == 0:
+            arrays[name] = np.zeros(0, dtype=layout['dtype'])
+        else:
+            arrays[name] = np.memmap(cachePath, dtype=layout['dtype'], mode='r',
+                                     offset=layout['offset'], shape=(layout['length'],))
+    corpus = rm.makeTrackCorpusFromArrays(arrays['rhythms'], arrays['pitches'],
+                                          arrays['newNotes'], arrays['trackOffsets'],
+                                          arrays['barLens'])
+    corpus.sources = metadata['sources']
+    return corpus
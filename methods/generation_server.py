@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+A long-lived generation service that keeps trained melody generators loaded
+in a pool of worker processes, so clients do not pay the model load cost on
+every use. Requests and responses are JSON objects, one per line, over a
+Unix socket or a localhost TCP connection.
+
+A request gives the model name, a track and the number of bars to generate:
+
+    {"id": 1, "model": "mg", "bars": 2, "seed": 7,
+     "notes": {"pitches": [...], "starts": [...], "durations": [...],
+               "barLen": 48, "length": 192}}
+
+where the track may instead be given as "midi", the base64 encoded bytes of
+a midi file, along with "trackNum". barLen defaults to the model's and length
+to the end of the last note, and either way the length is rounded up to whole
+bars. The response has the same id and either the generated bars, as "notes"
+starting from timestep 0, or an "error".
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from midi_events import decodeMidi
+import rhythm_melody as rm
+import midi
+import numpy as np
+import multiprocessing
+import asyncio
+import base64
+import socket
+import json
+import os
+
+# Starts a server generating with the models in models, a dict from model
+# names to the files they were saved in, and serves until cancelled. Listens
+# on socketPath if it is given and otherwise on host:port. Every worker
+# process (nJobs, None for every core) loads every model before the server
+# starts listening. At most maxPending requests are accepted at once; beyond that, the
+# server stops reading requests until one finishes. Requests taking longer
+# than timeout seconds are answered with an error, but hold their slot until
+# their job finishes.
+async def serveGeneration(models, socketPath=None, host='127.0.0.1', port=8765,
+                          nJobs=1, maxPending=32, timeout=30.0):
+    if nJobs is None:
+        nJobs = os.cpu_count()
+    warmUpBarrier = multiprocessing.Barrier(nJobs)
+    executor = ProcessPoolExecutor(nJobs, initializer=_initServerWorker,
+                                   initargs=(models, warmUpBarrier))
+    try:
+        # Load the models in every worker now rather than on each worker's
+        # first request. Workers start lazily, so one warm-up task is sent per
+        # worker, and the barrier stops any worker from taking two of them.
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(executor, _warmUpWorker)
+                               for w in range(nJobs)])
+        pending = asyncio.Semaphore(maxPending)
+        handler = lambda reader, writer: _handleConnection(reader, writer, executor,
+                                                           pending, timeout)
+        if socketPath is None:
+            server = await asyncio.start_server(handler, host, port)
+        else:
+            server = await asyncio.start_unix_server(handler, socketPath)
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def runGenerationServer(models, **kwargs):
+    asyncio.run(serveGeneration(models, **kwargs))
+
+async def _handleConnection(reader, writer, executor, pending, timeout):
+    writeLock = asyncio.Lock()
+    tasks = set()
+    try:
+        while True:
+            # Reading waits for a free slot, which holds back the client
+            await pending.acquire()
+            try:
+                line = await reader.readline()
+            except (ConnectionError, ValueError):
+                line = b''
+            if not line:
+                pending.release()
+                break
+            task = asyncio.ensure_future(_answer(line, writer, writeLock, executor,
+                                                 pending, timeout))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+async def _answer(line, writer, writeLock, executor, pending, timeout):
+    response = {'id': None}
+    loop = asyncio.get_running_loop()
+    try:
+        request = json.loads(line)
+        response['id'] = request.get('id')
+        job = executor.submit(_generate, request)
+    except Exception as e:
+        pending.release()
+        response['error'] = '{!r}'.format(e)
+    else:
+        # The request keeps its slot until the job itself finishes: a timeout
+        # only stops the wait, and a job already running keeps its worker
+        job.add_done_callback(lambda job: _releaseSlot(loop, pending))
+        try:
+            response['notes'] = await asyncio.wait_for(asyncio.wrap_future(job), timeout)
+        except asyncio.TimeoutError:
+            response['error'] = 'timed out after {} seconds'.format(timeout)
+        except Exception as e:
+            response['error'] = '{!r}'.format(e)
+    async with writeLock:
+        try:
+            writer.write((json.dumps(response) + '\n').encode('utf-8'))
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+# Called from the executor's thread when a job finishes
+def _releaseSlot(loop, pending):
+    try:
+        loop.call_soon_threadsafe(pending.release)
+    except RuntimeError:
+        # The server has already stopped
+        pass
+
+_serverModels = None
+_warmUpBarrier = None
+
+def _initServerWorker(models, warmUpBarrier):
+    global _serverModels, _warmUpBarrier
+    _serverModels = {name: rm.loadMelodyGenerator(filename)
+                     for (name, filename) in models.items()}
+    _warmUpBarrier = warmUpBarrier
+
+# Returns once every worker has loaded its models and taken a warm-up task
+def _warmUpWorker():
+    _warmUpBarrier.wait()
+    return os.getpid()
+
+# Decodes a request's track, generates its bars and returns them as notes
+def _generate(request):
+    if not request.get('model') in _serverModels:
+        raise KeyError('unknown model {!r}'.format(request.get('model')))
+    generator = _serverModels[request['model']]
+    track = requestTrack(request, generator.barLen)
+    randomState = None
+    if not request.get('seed') is None:
+        randomState = np.random.RandomState(request['seed'])
+    startLength = track.length
+    for b in range(int(request.get('bars', 1))):
+        track = generator.generateBars([track], seeds=[randomState])[0]
+    (_, generated) = midi.splitTrack(track, startLength)
+    generated.length = track.length - startLength
+    return trackNotes(generated)
+
+# Returns the track described by a request, running to the end of a bar
+def requestTrack(request, barLen):
+    if 'midi' in request:
+        mid = decodeMidi(base64.b64decode(request['midi']))
+        track = midi.makeTrackFromMidi(mid, int(request.get('trackNum', 0)))
+    else:
+        notes = request['notes']
+        track = midi.makeTrackFromArrays(np.array(notes['pitches'], dtype=np.int32),
+                                         np.array(notes['starts'], dtype=np.int32),
+                                         np.array(notes['durations'], dtype=np.int32),
+                                         barLen=notes.get('barLen', barLen))
+        track.length = max(track.length, int(notes.get('length', 0)))
+    # Generation continues from the end of the track, so it must be whole bars
+    track.length = int(-(-track.length // track.barLen) * track.barLen)
+    return track
+
+def trackNotes(track):
+    return {'pitches': track.pitches.tolist(), 'starts': track.starts.tolist(),
+            'durations': track.durations.tolist(), 'barLen': track.barLen,
+            'length': track.length}
+
+# Sends a single request to a running server and waits for the response,
+# returning the generated track. Raises RuntimeError if the server answers
+# with an error.
+def requestGeneration(request, socketPath=None, host='127.0.0.1', port=8765, timeout=None):
+    if socketPath is None:
+        connection = socket.create_connection((host, port), timeout)
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        connection.connect(socketPath)
+    with connection:
+        connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with connection.makefile('rb') as responses:
+            response = json.loads(responses.readline())
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    notes = response['notes']
+    track = midi.makeTrackFromArrays(np.array(notes['pitches'], dtype=np.int32),
+                                     np.array(notes['starts'], dtype=np.int32),
+                                     np.array(notes['durations'], dtype=np.int32),
+                                     barLen=notes['barLen'])
+    track.length = notes['length']
+    return track
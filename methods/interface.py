@@ -3,9 +3,9 @@
 Contains functions for input/output of data with the AI
 """
 
-from mido import MidiFile
-from os import listdir
-from os.path import isfile, join
+from midi_events import readMidiFile
+from corpus_cache import loadOrBuildCorpus, sourceFiles
+from os.path import join
 import midi
 import rhythm_melody as rm
 import pdb
@@ -14,6 +14,9 @@ import tkinter.filedialog as filedialog
 from tkinter.font import Font
 import time
 from queue import Queue, Empty
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
 import threading
 
 class Application(tk.Frame):
@@ -154,33 +157,54 @@ class Application(tk.Frame):
         except Empty:
             self.master.after(100, self.processEventQueue)
 
+# If corpusCache is given, the tracks are loaded from the compiled corpus file
+# at that path, as in loadMidisAndTrainGenerator
 class ThreadedTrainingTask(threading.Thread):
-    def __init__(self, eventQueue, mg, path, neuralNetEpochs):
+    def __init__(self, eventQueue, mg, path, neuralNetEpochs, corpusCache=None):
         threading.Thread.__init__(self)
         self.eventQueue = eventQueue
         self.mg = mg
         self.path = path
         self.neuralNetEpochs = neuralNetEpochs
+        self.corpusCache = corpusCache
     
     def run(self):
-        midis = loadMidis(self.path)
-        tracks = [midi.makeTrackFromMidi(m,0) for m in midis]
-        trackDS = rm.TrackDataSet(tracks)
+        if self.corpusCache is None:
+            trackDS = rm.TrackDataSet(streamTracks(self.path))
+        else:
+            trackDS = rm.TrackDataSet(corpus=loadOrBuildCorpus(self.path, self.corpusCache))
         self.mg.trainTimed(self.neuralNetEpochs, trackDS)
         self.eventQueue.put("Training complete!")
         
 
 def loadMidis(path):
-    midis = [MidiFile(join(path, m)) for m in listdir(path) if isfile(join(path, m)) and m[-4:]=='.mid']
+    midis = list(iterMidis(path))
     return midis
 
+# Parses the midi files in a directory one at a time, in sorted order
+def iterMidis(path):
+    for m in sourceFiles(path):
+        yield readMidiFile(join(path, m))
+
+# Yields the given track of each midi file in a directory, parsing only one
+# file at a time
+def streamTracks(path, trackNum=0):
+    for m in iterMidis(path):
+        yield midi.makeTrackFromMidi(m,trackNum)
+
+# If corpusDirectory is given, the training corpus is kept in files there
+# rather than in memory. If corpusCache is given, the corpus is instead loaded
+# from the compiled corpus file at that path, which is rebuilt first if the
+# midi files have changed since it was compiled.
 def loadMidisAndTrainGenerator(path, hiddenStates, hiddenLayer, netEpochs,
                                barLen, barCount, clusterCount, hmmIters=1000,
-                               filename=None):
-    midis = loadMidis(path)
-    tracks = [midi.makeTrackFromMidi(m,0) for m in midis]
+                               filename=None, corpusDirectory=None, corpusCache=None):
+    if corpusCache is None:
+        trackDS = rm.TrackDataSet(streamTracks(path), corpusDirectory)
+    else:
+        trackDS = rm.TrackDataSet(corpus=loadOrBuildCorpus(path, corpusCache))
     generator = rm.MelodyGenerator(hiddenStates, hiddenLayer, barLen, barCount, clusterCount, hmmIters=hmmIters)
-    generator.trainTimed(netEpochs, tracks)
+    generator.trainTimed(netEpochs, trackDS)
     if not (filename is None):
         generator.save(filename)
     return generator
@@ -188,35 +212,117 @@ def loadMidisAndTrainGenerator(path, hiddenStates, hiddenLayer, netEpochs,
 def loadMidisAndGenerate(path, generator):
     midis = loadMidis(path)
     tracks = [midi.makeTrackFromMidi(m,0) for m in midis]
-    trackEndings = [generator.generateBar(t) for t in tracks]
+    trackEndings = generator.generateBars(tracks)
     return trackEndings
 
 # Takes a set of bars to overwrite in the original melodies
 def loadMidisAndGenerateBars(path, generator, bars):
     midis = loadMidis(path)
+    tracks = [midi.makeTrackFromMidi(m,0) for m in midis]
+    return generateTrackBars(generator, tracks, bars)
+
+# Rebuilds the first barCount bars of each track, with the given bars 
+# replaced by generated ones. Every track follows the same schedule of bars, 
+# so the generated bars of all tracks are made together. seeds optionally 
+# gives a random seed for each track. Raises ValueError if a track's bar 
+# length differs from the generator's or it cannot be rebuilt to the right 
+# length.
+def generateTrackBars(generator, tracks, bars, seeds=None):
     for b in bars:
         assert b < generator.barCount, "Invalid bar count"
-    tracks = [midi.makeTrackFromMidi(m,0) for m in midis]
-    generated = []
-    for t in tracks:
-        startBar = 0
-        endBar = 0
-        totalTrack = midi.Track(barLen=generator.barLen)
-        while startBar < generator.barCount:
-            if startBar in bars:
-                totalTrack = generator.generateBar(totalTrack)
-                startBar += 1
-            else:
-                endBar = startBar+1
-                while (not endBar in bars) and (endBar < generator.barCount):
-                    endBar += 1
+    for (i, t) in enumerate(tracks):
+        if t.barLen != generator.barLen:
+            raise ValueError('Track {} has bar length {}, but the generator uses {}'.format(
+                i, t.barLen, generator.barLen))
+    # Each track draws all of its generated bars from its own random state
+    randomStates = None
+    if not seeds is None:
+        randomStates = [np.random.RandomState(s) for s in seeds]
+    totalTracks = [midi.Track(barLen=generator.barLen) for t in tracks]
+    # Sessions follow each track, so the HMM and the network only process each
+    # bar once
+    sessions = [generator.makeSession() for t in tracks]
+    startBar = 0
+    endBar = 0
+    while startBar < generator.barCount:
+        if startBar in bars:
+            totalTracks = generator.generateBars(totalTracks, seeds=randomStates, sessions=sessions)
+            startBar += 1
+        else:
+            endBar = startBar+1
+            while (not endBar in bars) and (endBar < generator.barCount):
+                endBar += 1
+            # The second split is relative to the start of the segment, and
+            # the copied bars keep their full length even if they end in rests
+            for (i, t) in enumerate(tracks):
                 (_,trackSeg) = midi.splitTrack(t, generator.barLen*startBar)
-                (trackSeg,_) = midi.splitTrack(trackSeg, generator.barLen*endBar)
-                totalTrack = midi.concatenateTracks([totalTrack,trackSeg])
-                startBar = endBar
+                (trackSeg,_) = midi.splitTrack(trackSeg, generator.barLen*(endBar-startBar))
+                totalTracks[i] = midi.concatenateTracks([totalTracks[i],trackSeg])
+                totalTracks[i].length = generator.barLen*endBar
+            startBar = endBar
+        for (i, totalTrack) in enumerate(totalTracks):
             if totalTrack.length != generator.barLen*startBar:
-                pdb.set_trace()
-                # If you got here something is wrong
-        generated.append(totalTrack)
-    return generated
-    
+                raise ValueError('Track {} is {} timesteps long after bar {}, not {}'.format(
+                    i, totalTrack.length, startBar, generator.barLen*startBar))
+    return totalTracks
+
+# As generateTrackBars, but returns a (track, error) pair for each track, 
+# where error is None on success and otherwise describes why the track 
+# failed. If the batch fails, each track is retried alone to find which ones 
+# are at fault.
+def generateTrackBarsSafely(generator, tracks, bars, seeds=None):
+    try:
+        return [(t, None) for t in generateTrackBars(generator, tracks, bars, seeds)]
+    except Exception as e:
+        if len(tracks) == 1:
+            return [(None, 'cannot generate bars: {!r}'.format(e))]
+    results = []
+    for (i, t) in enumerate(tracks):
+        results.extend(generateTrackBarsSafely(generator, [t], bars,
+                                               None if seeds is None else [seeds[i]]))
+    return results
+
+# Parallel version of loadMidisAndGenerateBars for large collections. The 
+# midi files are divided into chunks of chunkSize, which worker processes 
+# parse and generate in batches; each worker loads the generator saved at 
+# generatorFile once, through loadMelodyGenerator. nJobs = 1 runs in this 
+# process and None uses every core. Returns a (track, error) pair for each 
+# file, in sorted order of file name; see generateTrackBarsSafely. 
+# Tracks are seeded from seed, so results do not depend on nJobs or 
+# chunkSize.
+def loadMidisAndGenerateBarsParallel(path, generatorFile, bars, nJobs=None, chunkSize=8, seed=None):
+    paths = [join(path, m) for m in sourceFiles(path)]
+    randomState = np.random if seed is None else np.random.RandomState(seed)
+    trackSeeds = randomState.randint(2**31 - 1, size=len(paths))
+    chunks = [(paths[i:i+chunkSize], trackSeeds[i:i+chunkSize]) for i in range(0, len(paths), chunkSize)]
+    if nJobs == 1:
+        _initGenerationWorker(generatorFile)
+        chunkResults = [_generateChunk(chunkPaths, chunkSeeds, bars) for (chunkPaths, chunkSeeds) in chunks]
+    else:
+        with ProcessPoolExecutor(nJobs, initializer=_initGenerationWorker,
+                                 initargs=(generatorFile,)) as executor:
+            chunkResults = list(executor.map(_generateChunk, [c[0] for c in chunks],
+                                             [c[1] for c in chunks], repeat(bars)))
+    return [result for results in chunkResults for result in results]
+
+_workerGenerator = None
+
+def _initGenerationWorker(generatorFile):
+    global _workerGenerator
+    _workerGenerator = rm.loadMelodyGenerator(generatorFile)
+
+def _generateChunk(paths, seeds, bars):
+    results = [None]*len(paths)
+    tracks = []
+    trackIndices = []
+    for (i, path) in enumerate(paths):
+        try:
+            tracks.append(midi.makeTrackFromMidi(readMidiFile(path), 0))
+            trackIndices.append(i)
+        except Exception as e:
+            results[i] = (None, 'cannot read file: {!r}'.format(e))
+    generated = generateTrackBarsSafely(_workerGenerator, tracks, bars,
+                                        [seeds[i] for i in trackIndices])
+    for (i, result) in zip(trackIndices, generated):
+        results[i] = result
+    return results
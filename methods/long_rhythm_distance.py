@@ -3,10 +3,16 @@
 A hamming-distance-based model for predicting long term rhythmic patterns
 """
 from rhythm_hmm import Rhythm, makeRhythmSamples
+import rhythm_hmm as rh
+import midi
 import math
+import os
 import numpy as np
 from scipy.cluster.vq import vq, kmeans
 from scipy.stats import binom
+from scipy.special import logsumexp
+from concurrent.futures import ProcessPoolExecutor
+from parallel import SharedArrays, loadSharedArrays
 import pdb
 
 class StructuredRhythm(Rhythm):
@@ -30,95 +36,173 @@ class RhythmDistanceModel:
         self.converged = False
         self.minimumDistanceProb = 1/(self.barLen+1)
         self.maximumDistanceProb = 1 - self.minimumDistanceProb
-        
-    def train(self, rhythms, convergence=0.000001, maxIters=10000):
+        self.logProbTable = None
+
+    # The log probability table is derived from the fitted mixtures and is
+    # large, so it is left out of pickles and rebuilt when first needed
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['logProbTable'] = None
+        return state
+
+    # Pairs are independent, so they can be fitted in parallel by passing
+    # nJobs > 1 (None uses every core) or an existing executor. Each pair's
+    # k-means initialisation uses its own seed drawn from seed, so results do
+    # not depend on how the pairs are distributed
+    def train(self, rhythms, convergence=0.000001, maxIters=10000, nJobs=1,
+              executor=None, seed=None):
         for rhy in rhythms:
             assert len(rhy) == self.barCount*self.barLen, "Rhythms must correct number of measures and length"
-        for i in range(self.barCount-1):
-            for j in range(i+1,self.barCount):
-                #pdb.set_trace()
-                dists = [distance(r, i, j, self.barLen) for r in rhythms]
-                alphas = [alphaDist(r, i, j, self.barLen) for r in rhythms]
-                betas = [betaDist(r, i, j, self.barLen) for r in rhythms]
-                # Initialise parameter estimates
-                ijDS = np.zeros(len(rhythms))
-                for r in range(len(rhythms)):
-                    if alphas[r] - betas[r] == 0:
-                       ijDS[r] = 0
-                    else:
-                       ijDS[r] = (dists[r] - betas[r])/(alphas[r] - betas[r])
-                    ijDS[r] = max(min(ijDS[r],self.maximumDistanceProb),self.minimumDistanceProb)
-                centroids = kmeans(ijDS, self.clusterCount)[0]
-                # TODO: Bit of a hack, but necessary in some form
-                while len(centroids) < self.clusterCount:
-                    centroids = np.append(centroids, centroids[-1])
-                code = vq(ijDS, centroids)[0]
-                for k in range(self.clusterCount):
-                    n = sum(c == k for c in code)
-                    self.weights[i][j][k] = n / len(rhythms)
-                    self.probs[i][j][k] = centroids[k]
-                # Use iterative EM to refine parameters
-                converged = False
-                iters = 0
-                while (not converged) and (iters < maxIters):
-                    converged = True
-                    iters += 1
-                    clusterProbs = np.zeros((self.clusterCount,len(rhythms)))
-                    for k in range(self.clusterCount):
-                        for r in range(len(rhythms)):
-                            """
-                            TODO: Not sure about using this; the paper says to
-                            use dist but I think it's a typo - it doesn't make
-                            that much sense otherwise
-                            """
-                            delta = dists[r] - betas[r]
-                            clusterProbs[k][r] = (
-                                self.weights[i][j][k] *
-                                self.gradientBinomialDistanceProb(delta,alphas[r],betas[r],self.probs[i][j][k]))
-                    # Normalize cluster probabilities s.t. the total prob 
-                    # across clusters for a given rhythm is 1
-                    np.divide(clusterProbs, np.sum(clusterProbs,0))
-                    for k in range(self.clusterCount):
-                        numerator = 0.0
-                        denominator = 0.0
-                        for r in range(len(rhythms)):
-                            numerator += (dists[r] - betas[r]) * clusterProbs[k][r]
-                            denominator += (alphas[r] - betas[r]) * clusterProbs[k][r]
-                        oldProb = self.probs[i][j][k]
-                        oldWeight = self.weights[i][j][k]
-                        if denominator == 0:
-                            self.probs[i][j][k] = 0
-                        else:
-                            self.probs[i][j][k] = numerator/denominator
-                        self.probs[i][j][k] = max(min(
-                            self.probs[i][j][k],
-                            self.maximumDistanceProb),
-                            self.minimumDistanceProb)
-                        self.weights[i][j][k] = np.sum(clusterProbs[k])/len(rhythms)
-                        if abs(self.probs[i][j][k]-oldProb)/self.probs[i][j][k] > convergence:
-                            converged = False
-                        if abs(self.weights[i][j][k]-oldWeight)/self.weights[i][j][k] > convergence:
-                            converged = False
-        self.converged = converged
+        bars = makeBarArray(rhythms, self.barCount, self.barLen)
+        (allDists, allAlphas, allBetas) = barDistanceTensors(bars)
+        # Every (i, j) bar pair with i < j is fitted as one row of a batch
+        (pairI, pairJ) = np.triu_indices(self.barCount, 1)
+        dists = allDists[:,pairI,pairJ].T
+        alphas = allAlphas[:,pairI,pairJ].T
+        betas = allBetas[:,pairI,pairJ].T
+        """
+        TODO: Not sure about using this; the paper says to use dist but I
+        think it's a typo - it doesn't make that much sense otherwise
+        """
+        deltas = dists - betas
+        spans = alphas - betas
+        randomState = np.random if seed is None else np.random.RandomState(seed)
+        pairSeeds = randomState.randint(2**31 - 1, size=len(pairI))
+        weights = np.zeros((len(pairI),self.clusterCount))
+        probs = np.zeros((len(pairI),self.clusterCount))
+        converged = np.zeros(len(pairI), dtype=bool)
+        # With a single bar there are no pairs, and nothing to distribute
+        if (executor is None and nJobs == 1) or len(pairI) == 0:
+            (weights, probs, converged) = self.fitPairs(deltas, spans, pairSeeds, convergence, maxIters)
+        else:
+            with SharedArrays(deltas=deltas, spans=spans) as shared:
+                ownExecutor = executor is None
+                if ownExecutor:
+                    executor = ProcessPoolExecutor(nJobs)
+                    taskCount = min(nJobs or os.cpu_count(), len(pairI))
+                else:
+                    taskCount = len(pairI)
+                try:
+                    chunks = np.array_split(np.arange(len(pairI)), taskCount)
+                    futures = [executor.submit(_fitSharedPairs, self, shared.paths, chunk,
+                                               pairSeeds[chunk], convergence, maxIters)
+                               for chunk in chunks]
+                    for (chunk, future) in zip(chunks, futures):
+                        (weights[chunk], probs[chunk], converged[chunk]) = future.result()
+                finally:
+                    if ownExecutor:
+                        executor.shutdown()
+        self.weights[pairI,pairJ] = weights
+        self.probs[pairI,pairJ] = probs
+        self.converged = bool(np.all(converged))
+        self.buildLogProbTable()
+
+    # Fits the mixtures for a batch of bar pairs, with deltas and spans indexed
+    # by [pair, rhythm]: initialises each pair with k-means and then refines
+    # the whole batch with EM
+    def fitPairs(self, deltas, spans, pairSeeds, convergence, maxIters):
+        weights = np.zeros((len(deltas),self.clusterCount))
+        probs = np.zeros((len(deltas),self.clusterCount))
+        for p in range(len(deltas)):
+            (weights[p], probs[p]) = self.initialClusters(deltas[p], spans[p], pairSeeds[p])
+        return self.refineClusters(deltas, spans, weights, probs, convergence, maxIters)
+
+    # Returns initial cluster weights and probabilities for a single bar pair,
+    # found by k-means clustering of each rhythm's observed distance ratio
+    def initialClusters(self, deltas, spans, seed=None):
+        ijDS = np.zeros(len(deltas))
+        np.divide(deltas, spans, out=ijDS, where=(spans != 0))
+        ijDS = np.clip(ijDS, self.minimumDistanceProb, self.maximumDistanceProb)
+        # A seeded pair draws from its own generator, leaving the global one
+        # alone
+        randomState = None if seed is None else np.random.RandomState(seed)
+        centroids = kmeans(ijDS, self.clusterCount, seed=randomState)[0]
+        # TODO: Bit of a hack, but necessary in some form
+        while len(centroids) < self.clusterCount:
+            centroids = np.append(centroids, centroids[-1])
+        code = vq(ijDS, centroids)[0]
+        weights = np.bincount(code, minlength=self.clusterCount) / len(deltas)
+        return (weights, centroids)
+
+    # Runs EM on a batch of bar pairs at once. deltas and spans are indexed by
+    # [pair, rhythm], weights and probs by [pair, cluster]; a pair stops being
+    # updated once it has converged. Returns the refined weights and probs,
+    # and whether each pair converged within maxIters
+    def refineClusters(self, deltas, spans, weights, probs, convergence, maxIters):
+        weights = np.array(weights, dtype=float)
+        probs = np.array(probs, dtype=float)
+        rhythmCount = deltas.shape[1]
+        active = np.ones(len(weights), dtype=bool)
+        iters = 0
+        while np.any(active) and (iters < maxIters):
+            iters += 1
+            p = np.flatnonzero(active)
+            pDeltas = deltas[p][:,None,:]
+            pSpans = spans[p][:,None,:]
+            with np.errstate(divide='ignore'):
+                clusterLogProbs = np.log(weights[p])[:,:,None] + self.gradientBinomialDistanceLogProbs(
+                    pDeltas, pSpans, probs[p][:,:,None])
+            # Normalize cluster probabilities s.t. the total prob across
+            # clusters for a given rhythm is 1
+            clusterProbs = np.exp(clusterLogProbs - logsumexp(clusterLogProbs, axis=1, keepdims=True))
+            numerators = np.sum(pDeltas * clusterProbs, axis=2)
+            denominators = np.sum(pSpans * clusterProbs, axis=2)
+            newProbs = np.zeros(numerators.shape)
+            np.divide(numerators, denominators, out=newProbs, where=(denominators != 0))
+            newProbs = np.clip(newProbs, self.minimumDistanceProb, self.maximumDistanceProb)
+            newWeights = np.sum(clusterProbs, axis=2) / rhythmCount
+            with np.errstate(divide='ignore', invalid='ignore'):
+                changed = ((np.abs(newProbs - probs[p]) / newProbs > convergence) |
+                           (np.abs(newWeights - weights[p]) / newWeights > convergence))
+            probs[p] = newProbs
+            weights[p] = newWeights
+            active[p] = np.any(changed, axis=1)
+        return (weights, probs, ~active)
 
     # Returns a log probability of "bar" succeeding "rhythm" according to this
     # model
     def score(self, rhythm, bar):
         assert len(rhythm) % self.barLen == 0, "Rhythm length must be divisible by bar length"
         assert len(bar) == self.barLen, "Input bar has incorrect length"
-        totalProb = 0.0
         combinedRhythm = np.concatenate([rhythm, bar])
         j = int(len(rhythm) / self.barLen)
-        for i in range(j):
-            dist = distance(combinedRhythm, i, j, self.barLen)
-            alpha = alphaDist(combinedRhythm, i, j, self.barLen)
-            beta = betaDist(combinedRhythm, i, j, self.barLen)
-            delta = dist - beta
-            iProb = 0.0
-            for k in range(self.clusterCount):
-                iProb += self.weights[i][j][k] * self.gradientBinomialDistanceProb(delta,alpha,beta,self.probs[i][j][k])
-            totalProb += np.log(iProb)
-        return totalProb
+        bars = makeBarArray([combinedRhythm], j+1, self.barLen)
+        (dists, alphas, betas) = barDistanceTensors(bars)
+        return self.scoreDistances(j, dists[0,:j,j], alphas[0,:j,j], betas[0,:j,j])
+
+    # Returns the log probability of bar j given its distance, alpha and beta
+    # to each earlier bar i; the arrays are indexed by [..., i], and a score is
+    # returned for each leading index
+    def scoreDistances(self, j, dists, alphas, betas):
+        if getattr(self, 'logProbTable', None) is None:
+            self.buildLogProbTable()
+        return np.sum(self.logProbTable[np.arange(j), j, dists - betas, alphas - betas], axis=-1)
+
+    # Precomputes the log probability of every possible (delta, alpha - beta)
+    # combination for each bar pair, mixed over the clusters, so that scoring
+    # needs no binomial evaluations. Indexed by [i, j, delta, alpha - beta]
+    def buildLogProbTable(self):
+        deltas = np.arange(self.barLen+1)[:,None]
+        # alpha can be as large as twice the bar length
+        spans = np.arange(2*self.barLen+1)[None,:]
+        self.logProbTable = np.full((self.barCount,self.barCount,
+                                     self.barLen+1,2*self.barLen+1), -np.inf)
+        for i in range(self.barCount-1):
+            for j in range(i+1,self.barCount):
+                with np.errstate(divide='ignore'):
+                    clusterLogProbs = np.log(self.weights[i,j])[:,None,None] + self.gradientBinomialDistanceLogProbs(
+                        deltas, spans, self.probs[i,j][:,None,None])
+                self.logProbTable[i,j] = logsumexp(clusterLogProbs, axis=0)
+
+    # Array version of gradientBinomialDistanceProb, returning log
+    # probabilities; arguments are broadcast against each other
+    def gradientBinomialDistanceLogProbs(self, deltas, spans, probs):
+        logMinimum = np.log(self.minimumDistanceProb)
+        with np.errstate(divide='ignore'):
+            logProbs = np.clip(binom.logpmf(deltas, spans, probs),
+                               logMinimum, np.log(self.maximumDistanceProb))
+        impossibleLogProbs = np.where(deltas == 0, 0.0, (1+deltas) * logMinimum)
+        return np.where(spans == 0, impossibleLogProbs, logProbs)
     
     # As binomialDistanceProb below, but adds a gradient to impossible distance
     # value probabilities, so that all probabilities are non-zero and "more 
@@ -135,61 +219,198 @@ class RhythmDistanceModel:
             self.minimumDistanceProb)
         
 
-def generateNextBar(rdm, hmm, lam, rhythm, partitions=None):
-    assert len(rhythm) % rdm.barLen == 0, "Rhythm length must be divisible by bar length"
-    assert len(rhythm) < rdm.barLen * rdm.barCount, "Rhythm length must be less than distance model maximum"
+# Process pool task for RhythmDistanceModel.train
+def _fitSharedPairs(rdm, paths, pairs, pairSeeds, convergence, maxIters):
+    shared = loadSharedArrays(paths)
+    return rdm.fitPairs(shared['deltas'][pairs], shared['spans'][pairs],
+                        pairSeeds, convergence, maxIters)
+
+class BarScoringSession:
+    """Scores a batch of bars being generated, each after its own fixed 
+    history, one tick at a time. Arrays are indexed by [bar, ...], and 
+    methods taking rows only consider and update those bars of the batch.
+    
+    The histories' bar-to-bar distances are computed once; changing a tick of 
+    a new bar then updates its distance to each earlier bar in O(1), and the 
+    HMM term is found from cached forward and backward messages rather than 
+    by rescoring the whole sequence. Ticks are expected to be visited in 
+    order within a sweep, with beginSweep called at the start of each. 
+    Histories may have different numbers of bars; they are padded to the 
+    longest, and the padding is masked out of every score, so each bar's 
+    scores are the same whatever else is in the batch."""
+    
+    def __init__(self, rdm, hmm, histories, startSymbols, bars, startProbs, lam):
+        self.rdm = rdm
+        self.hmm = hmm
+        self.lam = lam
+        self.bar = np.array(bars, dtype=np.int8).reshape(len(histories), rdm.barLen)
+        self.j = np.array([int(len(h) / rdm.barLen) for h in histories], dtype=np.int64)
+        barCount = int(np.max(self.j)) if len(histories) > 0 else 0
+        self.historyBars = np.zeros((len(histories), barCount, rdm.barLen), dtype=np.int8)
+        for (b, history) in enumerate(histories):
+            self.historyBars[b,:self.j[b]] = makeBarArray([history], self.j[b], rdm.barLen)[0]
+        (self.historyDists, _, _) = barDistanceTensors(self.historyBars)
+        self.barDists = np.sum(self.historyBars != self.bar[:,None,:], axis=2)
+        barIndices = np.arange(barCount)
+        self.preceding = barIndices[None,:] < barIndices[:,None]
+        self.historyMask = barIndices[None,:] < self.j[:,None]
+        self.symbols = np.concatenate([np.reshape(startSymbols, (-1,1)), self.bar], axis=1).astype(int)
+        self.startProbs = np.asarray(startProbs)
+        self.candidates = np.arange(hmm.emissionprob_.shape[1])
+        self.forward = np.zeros(self.symbols.shape + (len(hmm.startprob_),))
+        self.forwardLogScales = np.zeros(self.symbols.shape)
+    
+    # Recomputes the backward messages for the current bars
+    def beginSweep(self, rows):
+        (self.forward[rows,0], self.forwardLogScales[rows,0]) = rh.batchForwardStart(
+            self.hmm, self.startProbs[rows], self.symbols[rows,0])
+        (self.backward, self.backwardLogScales) = rh.batchBackwardMessages(self.hmm, self.symbols[rows])
+        self.sweepRows = rows
+    
+    # Returns the score of each possible value of the given tick, indexed by
+    # [row, value], with the rest of each bar as it currently is
+    def candidateScores(self, tick, rows):
+        assert np.array_equal(rows, self.sweepRows), "Rows must match those of the sweep"
+        # Sequence position of the tick, after the start symbol
+        t = tick + 1
+        predicted = np.einsum('bs,st->bt', self.forward[rows,t-1], self.hmm.transmat_)
+        hmmScores = (np.sum(self.forwardLogScales[rows,:t], axis=1)[:,None] +
+                     self.backwardLogScales[:,t,None] +
+                     np.log(np.einsum('bs,sc->bc', predicted * self.backward[:,t], self.hmm.emissionprob_)))
+        historyTicks = self.historyBars[rows,:,tick]
+        changes = ((self.candidates[None,:,None] != historyTicks[:,None,:]).astype(int) -
+                   (self.bar[rows,tick,None] != historyTicks)[:,None,:])
+        distScores = self.distanceScores(self.barDists[rows,None,:] + changes, rows)
+        return hmmScores + (self.lam * distScores)
+    
+    # Fixes the values of the given tick and advances the forward messages 
+    # past it
+    def setTick(self, tick, rows, values):
+        historyTicks = self.historyBars[rows,:,tick]
+        self.barDists[rows] += ((values[:,None] != historyTicks).astype(int) -
+                                (self.bar[rows,tick,None] != historyTicks))
+        self.bar[rows,tick] = values
+        self.symbols[rows,tick+1] = values
+        (self.forward[rows,tick+1], self.forwardLogScales[rows,tick+1]) = rh.batchForwardStep(
+            self.hmm, self.forward[rows,tick], values)
+    
+    # Distance model score of each new bar given its distances to each 
+    # earlier bar, indexed by [row, ..., bar]
+    def distanceScores(self, barDists, rows):
+        scores = np.zeros(barDists.shape[:-1])
+        if barDists.shape[-1] == 0:
+            return scores
+        historyDists = self.historyDists[rows][:,None]
+        toBar = barDists[...,None,:]
+        alphas = np.where(self.preceding, historyDists + toBar, np.iinfo(np.int32).max).min(axis=-1)
+        betas = np.where(self.preceding, np.abs(historyDists - toBar), -1).max(axis=-1)
+        # The first bar has no preceding bars, so uses the plain distance
+        alphas[...,0] = barDists[...,0]
+        betas[...,0] = barDists[...,0]
+        # Bars past the end of a history are scored as zero
+        mask = self.historyMask[rows][:,None,:]
+        if getattr(self.rdm, 'logProbTable', None) is None:
+            self.rdm.buildLogProbTable()
+        logProbs = self.rdm.logProbTable[np.arange(barDists.shape[-1]), self.j[rows][:,None,None],
+                                         np.where(mask, barDists - betas, 0),
+                                         np.where(mask, alphas - betas, 0)]
+        for i in range(barDists.shape[-1]):
+            scores += np.where(mask[...,i], logProbs[...,i], 0.0)
+        return scores
+
+# Generates the next bar of each of a set of rhythms together, returning them
+# as a (rhythms, barLen) array. Each bar is the same as if its rhythm were
+# generated alone; randomStates optionally gives a RandomState (or seed) to 
+# sample each bar with, and otherwise the HMM's own random state is used.
+# sessions optionally gives a rhythm_hmm.RhythmHMMSession for each rhythm, 
+# which replaces running the HMM over the whole rhythm: a session behind its
+# rhythm is extended with the rest of the rhythm. Sessions are not extended
+# with the generated bars, which only join the rhythm once the caller has 
+# added them to its track; the next call catches up from the track.
+def generateNextBars(rdm, hmm, lam, rhythms, randomStates=None, sessions=None):
+    for rhythm in rhythms:
+        assert len(rhythm) % rdm.barLen == 0, "Rhythm length must be divisible by bar length"
+        assert len(rhythm) < rdm.barLen * rdm.barCount, "Rhythm length must be less than distance model maximum"
+    if randomStates is None:
+        randomStates = [None]*len(rhythms)
+    # A seed must become a single RandomState, as the HMM is sampled twice
+    randomStates = [np.random.RandomState(r) if isinstance(r, (int, np.integer)) else r
+                    for r in randomStates]
     # Generate notes
     # TODO: Use predict_proba instead to achieve a more accurate range of results
     #startState = hmm.predict(rhythm)[-1]
     #startStateProbs = [0]*len(hmm.startprob_)
     #startStateProbs[startState] = 1.0
-    startStateProbs = hmm.predict_proba(rhythm)[-1]
+    lengths = [len(r) for r in rhythms]
+    if sessions is None:
+        startStateProbs = hmm.predict_proba(np.concatenate(rhythms), lengths)[np.cumsum(lengths)-1]
+    else:
+        for (session, rhythm) in zip(sessions, rhythms):
+            if session.length > len(rhythm):
+                raise ValueError('Session has seen {} timesteps, but the rhythm has only {}'.format(
+                    session.length, len(rhythm)))
+            session.extend(rhythm[session.length:])
+        startStateProbs = np.array([session.stateProbs() for session in sessions])
     tempProbs = hmm.startprob_
-    hmm.startprob_ = startStateProbs
-    startSymbol = hmm.sample(1)[0][0]
-    barOut = np.concatenate(hmm.sample(rdm.barLen+1)[0])[1:]
-    rhythmSteps = np.concatenate(rhythm)
-    end = False
-    while end == False:
-        end = True
-        for j in range(rdm.barLen):
-            startVal = barOut[j]
-            bestVal = 0
-            bestScore = -np.inf
-            for newVal in range(3):
-                newBar = barOut
-                newBar[j] = newVal
-                hmmScore = hmm.score(np.concatenate([startSymbol,newBar]).reshape(-1,1))
-                distScore = rdm.score(rhythmSteps, newBar)
-                newScore = hmmScore + (lam * distScore)
-                if newScore > bestScore:
-                    bestScore = newScore
-                    bestVal = newVal
-            barOut[j] = bestVal
-            # Converge only when no values are changed
-            if bestVal != startVal:
-                end = False
+    startSymbols = []
+    barsOut = []
+    for (probs, randomState) in zip(startStateProbs, randomStates):
+        hmm.startprob_ = probs
+        startSymbols.append(hmm.sample(1, random_state=randomState)[0][0])
+        barsOut.append(np.concatenate(hmm.sample(rdm.barLen+1, random_state=randomState)[0])[1:])
     hmm.startprob_ = tempProbs
-    return barOut
+    session = BarScoringSession(rdm, hmm, [np.concatenate(r) for r in rhythms], startSymbols,
+                                barsOut, startStateProbs, lam)
+    # Bars leave the batch once a sweep changes none of their values
+    rows = np.arange(len(rhythms))
+    while len(rows) > 0:
+        session.beginSweep(rows)
+        changed = np.zeros(len(rows), dtype=bool)
+        for j in range(rdm.barLen):
+            startVals = session.bar[rows,j]
+            bestVals = np.argmax(session.candidateScores(j, rows), axis=1)
+            session.setTick(j, rows, bestVals)
+            changed |= bestVals != startVals
+        rows = rows[changed]
+    return session.bar.astype(np.asarray(barsOut).dtype)
+
+def generateNextBar(rdm, hmm, lam, rhythm, partitions=None, session=None):
+    return generateNextBars(rdm, hmm, lam, [rhythm],
+                            sessions=None if session is None else [session])[0]
 
 def makeTrackStructuredRhythm(track, ticksPerBar):
-    assert track.isMonophonic(), "Only monophonic tracks can be enscribed"
     rhythm = StructuredRhythm(ticksPerBar)
-    rhythm.timesteps = [0]*track.length
-    noteStart = 0
-    noteEnd = 0
-    n = -1
-    for t in range(track.length):
-        if noteEnd <= t:
-            n = n + 1
-            noteStart = track.notes[n].start
-            noteEnd = track.notes[n].start + track.notes[n].duration
-        if t == noteStart:
-            rhythm.timesteps[t] = 1
-        elif noteStart < t and t < noteEnd:
-            rhythm.timesteps[t] = 2
+    (rhythm.timesteps, _) = midi.rasterizeTrack(track)
     return rhythm
     
+# Converts a set of rhythms, each barCount bars long, into a single
+# (rhythms, barCount, barLen) array of bars
+def makeBarArray(rhythms, barCount, barLen):
+    bars = np.array(rhythms, dtype=np.int8)
+    return bars.reshape(len(rhythms), barCount, barLen)
+
+# Computes distance, alphaDist and betaDist for every pair of bars in every
+# rhythm of an array returned by makeBarArray; returns three arrays indexed by
+# [rhythm, barA, barB]
+def barDistanceTensors(bars):
+    (rhythmCount, barCount, _) = bars.shape
+    dists = np.zeros((rhythmCount, barCount, barCount), dtype=np.int32)
+    for a in range(barCount):
+        dists[:,a,:] = np.sum(bars[:,a:a+1,:] != bars, axis=2)
+    # Distances of both bars in a pair to every third bar
+    toA = dists[:,:,None,:]
+    toB = dists[:,None,:,:]
+    barIndices = np.arange(barCount)
+    lesser = np.minimum(barIndices[:,None], barIndices[None,:])
+    # Only bars preceding both bars of a pair are considered
+    preceding = barIndices[None,None,:] < lesser[:,:,None]
+    alphas = np.where(preceding, toA + toB, np.iinfo(np.int32).max).min(axis=3)
+    betas = np.where(preceding, np.abs(toA - toB), -1).max(axis=3)
+    # Pairs with no preceding bars fall back to the plain distance
+    alphas = np.where(lesser == 0, dists, alphas)
+    betas = np.where(lesser == 0, dists, betas)
+    return (dists, alphas, betas)
+
 def distance(rhythm, barA, barB, ticksPerBar):
     tickA = ticksPerBar * barA
     tickB = ticksPerBar * barB
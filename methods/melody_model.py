@@ -13,11 +13,15 @@ from pybrain.supervised.trainers import BackpropTrainer
 from pybrain.tools.shortcuts import buildNetwork
 from scipy import dot
 from scipy.integrate import odeint
+from collections import OrderedDict
 import operator
 import midi
+import model_format
+import network_training
 import numpy as np
 import time
 import random
+import os
 
 ShortestNoteDenominator = midi.timestepsPerBeat * 4
 
@@ -64,101 +68,89 @@ def getCyclePitch(pitch):
     out[4+minorThirdPitch] = 1
     return out
 
-def makeNoteSample(pitch, duration, inspirationPitch, bar):
-    sample = [int(0)] * sampleSize()
-    currentPos = 0
-    # Pitch
-    sample[currentPos:currentPos+7] = getCyclePitch(pitch)
-    currentPos += 7
-    # Octave
+# Lookup tables for the fields of samples and targets, built with the
+# functions above: the pitch and octave fields of each MIDI pitch, the 
+# duration field of each duration up to the longest encodable, the pitch 
+# field alone of each pitch class (for inspiration) and the bar field of each
+# bar. Durations are indexed directly, so row 0 holds what the string 
+# encoding gave for a duration of 0.
+barBits = int(np.ceil(np.log2(8)))
+
+def octaveField(pitch):
     octave = np.floor(pitch / 12) - 1
     octave = max(min(octave,6),4) # Clamp octave range
-    if octave == 4:
-        sample[currentPos+0] = 1
-    elif octave == 6:
-        sample[currentPos+1] = 1
-    currentPos += 2
-    # Duration
-    durationString = getBinaryString(durationLen(), duration-1)
-    for i in range(len(durationString)):
-        if durationString[i] == '1':
-            sample[currentPos+i] = 1
-    currentPos += (len(durationString))
-    # Inspiration
-    sample[currentPos:currentPos+7] = getCyclePitch(inspirationPitch)
-    currentPos += 7
-    # Bars
-    barString = getBinaryString(int(np.ceil(np.log2(8))), bar)
-    for i in range(len(barString)):
-        if barString[i] == '1':
-            sample[currentPos+i] = 1
-    currentPos += len(barString)
-    return sample
+    return [int(octave == 4), int(octave == 6)]
+
+def bitField(maxLen, val):
+    return [int(c == '1') for c in getBinaryString(maxLen, val)]
+
+pitchClassTable = np.array([getCyclePitch(p) for p in range(12)], dtype=np.int8)
+pitchTable = np.array([getCyclePitch(p) + octaveField(p) for p in range(128)], dtype=np.int8)
+durationTable = np.array([bitField(durationLen(), d-1) for d in range(2**durationLen()+1)],
+                         dtype=np.int8)
+barTable = np.array([bitField(barBits, b) for b in range(2**barBits)], dtype=np.int8)
+# The pitch class with each (major third, minor third) position
+cyclePitchClasses = np.zeros((4,3), dtype=np.int64)
+cyclePitchClasses[np.arange(12) % 4, np.arange(12) % 3] = np.arange(12)
+durationWeights = 2**np.arange(durationLen()-1, -1, -1)
+
+def checkRange(values, size, name):
+    assert len(values) == 0 or (np.min(values) >= 0 and np.max(values) < size), \
+           "{} must be in the range 0 to {}".format(name, size-1)
+
+# Returns the input samples of a set of notes as rows of a float array,
+# gathered from the tables
+def makeNoteSamples(pitches, durations, inspirationPitches, bars):
+    pitches = np.asarray(pitches, dtype=np.int64)
+    durations = np.asarray(durations, dtype=np.int64)
+    bars = np.asarray(bars, dtype=np.int64)
+    checkRange(pitches, len(pitchTable), 'Pitches')
+    checkRange(durations, len(durationTable), 'Durations')
+    checkRange(bars, len(barTable), 'Bars')
+    return np.concatenate([pitchTable[pitches],
+                           durationTable[durations],
+                           pitchClassTable[np.asarray(inspirationPitches, dtype=np.int64) % 12],
+                           barTable[bars]], axis=1).astype(np.float64)
+
+def makeNoteTargets(pitches, durations):
+    pitches = np.asarray(pitches, dtype=np.int64)
+    durations = np.asarray(durations, dtype=np.int64)
+    checkRange(pitches, len(pitchTable), 'Pitches')
+    checkRange(durations, len(durationTable), 'Durations')
+    return np.concatenate([pitchTable[pitches], durationTable[durations]],
+                          axis=1).astype(np.float64)
+
+def makeNoteSample(pitch, duration, inspirationPitch, bar):
+    return makeNoteSamples([pitch], [duration], [inspirationPitch], [bar])[0]
     
 def makeNoteTarget(pitch, duration):
-    sample = [int(0)] * outputSize()
-    # Pitch
-    majorThirdPitch = pitch % 4
-    minorThirdPitch = pitch % 3
-    sample[majorThirdPitch] = 1
-    sample[4+minorThirdPitch] = 1
-    # Octave
-    octave = np.floor(pitch / 12) - 1
-    octave = max(min(octave,6),4) # Clamp octave range
-    if octave == 4:
-        sample[7] = 1
-    elif octave == 6:
-        sample[8] = 1
-    # Duration
-    durationString = getBinaryString(durationLen(), duration-1)
-    for i in range(len(durationString)):
-        if durationString[i] == '1':
-            sample[9+i] = 1
-    return sample
+    return makeNoteTargets([pitch], [duration])[0]
     
 def getPitchDurationFromSample(sample):
-    majorThirdPitch = 0
-    minorThirdPitch = 0
-    for i in range(0,4):
-        if sample[i] == 1:
-            majorThirdPitch = i 
-    for i in range(4,7):
-        if sample[i] == 1:
-            minorThirdPitch = i-4
-    inOctavePitch = 0
-    # Could use the chinese remainder theorem, might save valuable picoseconds
-    for i in range(12):
-        if i % 4 == majorThirdPitch and i % 3 == minorThirdPitch:
-            inOctavePitch = i
+    sample = np.asarray(sample)
+    # The last set position of each third, as in the string decoding
+    majorThirdPitch = ([0] + list(np.flatnonzero(sample[0:4] == 1)))[-1]
+    minorThirdPitch = ([0] + list(np.flatnonzero(sample[4:7] == 1)))[-1]
     octave = 5
     if sample[7] == 1:
         octave = 4
     elif sample[8] == 1:
         octave = 6
-    pitch = ((octave+1)*12) + inOctavePitch
-    durationString = ''
-    for i in range(9,9+durationLen()):
-        durationString += str(sample[i])
-    duration = getDurationValue(durationString)
+    pitch = ((octave+1)*12) + int(cyclePitchClasses[majorThirdPitch, minorThirdPitch])
+    duration = int(np.dot(sample[9:9+durationLen()] == 1, durationWeights)) + 1
     return (pitch,duration)
     
 def normalizeOutputSample(sample, durationThreshold=0.5, octaveThreshold=0.5):
-    normalSample = [int(0)] * outputSize()
-    majorThirdPitch = max(enumerate(sample[0:4]),key=operator.itemgetter(1))[0]
-    minorThirdPitch = max(enumerate(sample[4:7]),key=operator.itemgetter(1))[0]
-    octave = 5
+    sample = np.asarray(sample)
+    normalSample = np.zeros(outputSize(), dtype=np.int64)
+    normalSample[np.argmax(sample[0:4])] = 1
+    normalSample[4+np.argmax(sample[4:7])] = 1
     if sample[7] >= octaveThreshold or sample[8] >= octaveThreshold:
         if sample[7] > sample[8]:
-            octave = 4
+            normalSample[7] = 1
         else:
-            octave = 6
-    normalSample[majorThirdPitch] = 1
-    normalSample[4+minorThirdPitch] = 1
-    if octave == 4:
-        normalSample[7] = 1
-    elif octave == 6:
-        normalSample[8] = 1
-    normalSample[9:] = [int(x >= durationThreshold) for x in sample[9:]]
+            normalSample[8] = 1
+    normalSample[9:] = sample[9:] >= durationThreshold
     return normalSample
     
 
@@ -193,11 +185,12 @@ def makeTrackFromMelody(melody, barLen):
         totalTime += note.duration
     return track
 
-def buildElmanNetwork(hiddenSize):
+# See todd_ann.buildToddNetwork for inSize and outSize
+def buildElmanNetwork(hiddenSize, inSize=None, outSize=None):
     net = RecurrentNetwork()
-    inLayer = LinearLayer(sampleSize())
+    inLayer = LinearLayer(sampleSize() if inSize is None else inSize)
     hiddenLayer = SigmoidLayer(hiddenSize)
-    outLayer = SigmoidLayer(outputSize())
+    outLayer = SigmoidLayer(outputSize() if outSize is None else outSize)
     net.addInputModule(inLayer)
     net.addModule(hiddenLayer)
     net.addOutputModule(outLayer)
@@ -217,7 +210,16 @@ def buildLstmNetwork(hiddenSize):
     net.randomize()
     return net
     
-def trainNetwork(net, ds, epochs, learningrate = 0.01, momentum=0.4, weightdecay = 0.0):
+# backend is 'numpy' to train with network_training, which takes batchSize 
+# and truncation (see network_training.trainNetwork), or 'pybrain' to use 
+# pybrain's BackpropTrainer, which LSTM networks require
+def trainNetwork(net, ds, epochs, learningrate = 0.01, momentum=0.4, weightdecay = 0.0,
+                 backend='numpy', batchSize=1, truncation=None):
+    if backend == 'numpy':
+        network_training.trainNetwork(net, ds, epochs, learningrate=learningrate,
+                                      momentum=momentum, weightdecay=weightdecay,
+                                      batchSize=batchSize, truncation=truncation)
+        return
     trainer = BackpropTrainer(net,
                               dataset=ds,
                               learningrate=learningrate,
@@ -256,17 +258,14 @@ class scale:
 #        self.mode = mode
 #        self.structure = structure
 #        self.toneDivision = toneDivision
+        self._tablesKey = None
         
     def tuningFactor(self):
         return 1/2
         
     # Step 1: Scale Generation
     def getFrequencyRatioVector(self):
-        ratios = []
-        for i in range(int(self.numOctaves*6/self.tuningFactor())):
-            if i % (6/self.tuningFactor()) in self.notes:
-                ratios.append(2**(i*self.tuningFactor()/6))
-        return ratios
+        return self.tables()[0]
     
     # Converts a set of note indices within the scale to their MIDI pitches
     def notesToPitches(self, notes):
@@ -275,11 +274,30 @@ class scale:
                     +self.notes[n % len(self.notes)]) for n in notes]
         return pitches
 
+    # Returns the frequency ratio of each note of the scale, in increasing 
+    # order, and the MIDI pitch of each note, computed once and then cached 
+    # until the scale changes
+    def tables(self):
+        if self._tablesKey != self.key():
+            ratios = []
+            for i in range(int(self.numOctaves*6/self.tuningFactor())):
+                if i % (6/self.tuningFactor()) in self.notes:
+                    ratios.append(2**(i*self.tuningFactor()/6))
+            self._ratioVector = np.array(ratios)
+            self._pitchTable = np.array(self.notesToPitches(range(len(ratios))), dtype=np.int64)
+            self._tablesKey = self.key()
+        return (self._ratioVector, self._pitchTable)
+
+    # Identifies the scale by value, for caching
+    def key(self):
+        return (self.numOctaves, self.root, self.rootOctave, tuple(self.notes))
+
 majorNotes = [0,2,4,5,7,9,11]
 minorNotes = [0,2,3,5,7,8,10]
 
 NurseryScale = scale(2,0,5,majorNotes)
 
+# Works on a single state or on arrays of states indexed by [variable, ...]
 def lorenzDerivatives(state, t, s=10, r=28, b=8/3):
     x = state[0]
     y = state[1]
@@ -288,38 +306,95 @@ def lorenzDerivatives(state, t, s=10, r=28, b=8/3):
     yd = r*x - y - x*z
     zd = x*y - b*z
     return (xd,yd,zd)
+
+# Fixed RK4 steps taken between consecutive output times; with the default
+# 100 outputs over 100 time units this is a step of about 0.02
+lorenzSubsteps = 50
     
 def solveLorenzSystem(initialState, steps, start=100.0, stop=200.0):
     t = np.linspace(start, stop, steps)
     state = odeint(lorenzDerivatives, initialState, t)
     return state
 
+# Solves the Lorenz system from each of a set of initial states, taken to be 
+# the state at time start, returning the states at steps evenly spaced times 
+# up to stop, indexed by [initial state, time, variable]. All trajectories 
+# are advanced together with fixed step RK4; each one depends only on its 
+# own initial state, not on the rest of the batch. The system is chaotic, so
+# these are not the trajectories solveLorenzSystem gives, and a batch costs
+# about as much as four odeint calls: only use it for large batches of states
+# whose exact trajectories do not matter, such as random ones.
+def solveLorenzSystems(initialStates, steps, start=100.0, stop=200.0):
+    state = np.array(initialStates, dtype=np.float64).reshape(-1,3).T
+    h = (stop - start) / max(steps - 1, 1) / lorenzSubsteps
+    states = np.zeros((steps,) + state.shape)
+    states[0] = state
+    for i in range(1, steps):
+        for k in range(lorenzSubsteps):
+            k1 = np.array(lorenzDerivatives(state, 0))
+            k2 = np.array(lorenzDerivatives(state + h/2*k1, 0))
+            k3 = np.array(lorenzDerivatives(state + h/2*k2, 0))
+            k4 = np.array(lorenzDerivatives(state + h*k3, 0))
+            state = state + h/6*(k1 + 2*k2 + 2*k3 + k4)
+        states[i] = state
+    return states.transpose(2,0,1)
+
 def generateChaoticInspiration(scale, chaosState, chaosSteps=100):
-    frv = scale.getFrequencyRatioVector()
-    chaos = solveLorenzSystem(chaosState, chaosSteps)
-    chaosXs = np.array([state[0] for state in chaos])
-    chaosRatio = (max(frv) - min(frv)) / (max(chaosXs) - min(chaosXs))
-    chaosXs *= chaosRatio       #Scale
-    chaosXs += (1-min(chaosXs)) #Translate
+    chaosXs = solveLorenzSystem(chaosState, chaosSteps)[:,0]
+    return chaosPitches(scale, chaosXs[None,:])[0]
+
+# Returns the pitches of the chaotic melody starting from each of a set of
+# initial states, solving all of them together with solveLorenzSystems
+def generateChaoticInspirations(scale, chaosStates, chaosSteps=100):
+    return chaosPitches(scale, solveLorenzSystems(chaosStates, chaosSteps)[:,:,0])
+
+# Quantizes each row of chaosXs, the x values of a chaotic trajectory, to the
+# pitches of the scale
+def chaosPitches(scale, chaosXs):
+    (frv, pitchTable) = scale.tables()
+    chaosRatio = (np.max(frv) - np.min(frv)) / (np.max(chaosXs, axis=1) - np.min(chaosXs, axis=1))
+    chaosXs *= chaosRatio[:,None]                          #Scale
+    chaosXs += (1 - np.min(chaosXs, axis=1))[:,None]       #Translate
     # chaosXs is now normalized
-    noteIndices = [0]*len(chaosXs)
-    for i in range(len(chaosXs)):
-        bestInd = 0
-        minDist = np.inf
-        for j in range(len(frv)):
-            newDist = abs(chaosXs[i] - frv[j])
-            if newDist < minDist:
-                minDist = newDist
-                bestInd = j
-            else:
-                break
-        noteIndices[i] = bestInd
-    #noteIndex now has the index within the user scale of the chaotic melody
-    pitches = scale.notesToPitches(noteIndices)
-    return pitches
-
-# Reseeds random
-def hashInspiration(length,melody,scale=NurseryScale):
+    noteIndices = nearestRatioIndices(frv, chaosXs)
+    #noteIndices now has the index within the user scale of each chaotic melody
+    return pitchTable[noteIndices].tolist()
+
+# Returns the index of the ratio nearest to each value, taking the lower
+# index on ties. This is the note a scan up the ratios would stop at, on
+# reaching the first ratio no nearer than the one before: as the ratios
+# strictly increase, the distances fall and then rise, so the scan stops 
+# just past the nearest ratio.
+def nearestRatioIndices(frv, values):
+    assert np.all(np.diff(frv) > 0), "Frequency ratios must be strictly increasing"
+    upper = np.minimum(np.searchsorted(frv, values, side='left'), len(frv)-1)
+    lower = np.maximum(upper-1, 0)
+    return np.where(np.abs(values - frv[upper]) < np.abs(values - frv[lower]), upper, lower)
+
+class InspirationCache:
+    """The chaotic inspiration of each (scale, initial state) pair requested,
+    keeping the maxSize most recently used. Each state is solved on its own 
+    with generateChaoticInspiration, so a cached inspiration is the same as 
+    an uncached one."""
+
+    def __init__(self, maxSize=4096):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+
+    def inspiration(self, scale, chaosState):
+        key = (scale.key(), tuple(float(v) for v in chaosState))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        else:
+            self.entries[key] = generateChaoticInspiration(scale, key[1])
+            if len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+        return self.entries[key]
+
+inspirationCache = InspirationCache()
+
+# The initial state hashInspiration uses for a melody; reseeds random
+def hashInspirationState(melody):
     seedVal = 0
     for i in range(len(melody.pitches)):
         seedVal += melody.pitches[i]
@@ -329,14 +404,24 @@ def hashInspiration(length,melody,scale=NurseryScale):
     yVal = random.random()*10
     zVal = random.random()*10
     random.seed()
-    inspiration = generateChaoticInspiration(scale,[xVal,yVal,zVal])
+    return (xVal,yVal,zVal)
+
+def hashInspiration(length,melody,scale=NurseryScale):
+    inspiration = inspirationCache.inspiration(scale, hashInspirationState(melody))
     return inspiration[10:10+length]
 
+# randomInspiration draws from a bank of inspirations for each scale, solved
+# randomBankSize at a time from random initial states with the batched solver
+randomBankSize = 64
+randomInspirationBank = {}
+
 def randomInspiration(length,melody=None,scale=NurseryScale):
-    xVal = random.random()*10
-    yVal = random.random()*10
-    zVal = random.random()*10
-    inspiration = generateChaoticInspiration(scale,[xVal,yVal,zVal])
+    bank = randomInspirationBank.setdefault(scale.key(), [])
+    if len(bank) == 0:
+        states = [(random.random()*10, random.random()*10, random.random()*10)
+                  for i in range(randomBankSize)]
+        bank.extend(reversed(generateChaoticInspirations(scale, states)))
+    inspiration = bank.pop()
     return inspiration[10:10+length]
     
 
@@ -372,17 +457,50 @@ class MelodyGenerator:
         trackOut = makeTrackFromMelody(melody, self.barLen)
         return trackOut
 
+    # Saves the generator in the versioned format of model_format
+    def save(self, filename):
+        arrays = {'barLen': self.barLen, 'barCount': self.barCount}
+        arrays.update(model_format.networkArrays(self.net))
+        model_format.saveModel(filename, 'melody_model', arrays)
+
+def loadMelodyGenerator(filename):
+    arrays = model_format.loadModel(filename, 'melody_model')
+    mg = MelodyGenerator(arrays['net_inWeights'].shape[0], int(arrays['barLen']),
+                         int(arrays['barCount']))
+    mg.net = model_format.restoreNetwork(arrays, buildElmanNetwork)
+    return mg
+
+# Converts an Elman network saved by pybrain's NetworkWriter into a generator
+# in the versioned format, saved to npzPath or, by default, beside the xml.
+# The xml holds only the network, so the bar length and count are given. 
+# The network keeps its saved layer sizes.
+def convertXmlNetwork(xmlPath, barLen, barCount, npzPath=None):
+    if npzPath is None:
+        npzPath = os.path.splitext(xmlPath)[0] + '.npz'
+    arrays = {'barLen': barLen, 'barCount': barCount}
+    arrays.update(model_format.readXmlNetworkArrays(xmlPath))
+    model_format.saveModel(npzPath, 'melody_model', arrays)
+    return npzPath
+
 
 def makeMelodyDataSet(melodies, inspirationFunc=randomInspiration, inspirationLength=8):
-    seqDataSet = SequentialDataSet(sampleSize(), outputSize())
+    melodies = list(melodies)
     for m in melodies:
         barCount = m.bars[-1]+1
         assert barCount <= 8, "Bar counts greater than 8 unsupported"
-        inspiration = inspirationFunc(inspirationLength,m)
-        seqDataSet.newSequence()
-        for s in range(len(m.pitches)-1):
-            seqDataSet.addSample(
-                makeNoteSample(m.pitches[s], m.durations[s],
-                               inspiration[s % inspirationLength], m.bars[s]),
-                makeNoteTarget(m.pitches[s+1], m.durations[s+1]))
-    return seqDataSet
+    inspirations = [inspirationFunc(inspirationLength,m) for m in melodies]
+    # Each melody gives a sample for every note but the last, and all of the
+    # samples are encoded together
+    lengths = [max(m.length()-1, 0) for m in melodies]
+    rows = lambda values, offset=0: np.concatenate(
+        [np.asarray(v, dtype=np.int64)[offset:offset+l] for (v, l) in zip(values, lengths)] +
+        [np.zeros(0, dtype=np.int64)])
+    inspirationNotes = [np.asarray(inspiration)[np.arange(l) % inspirationLength]
+                        for (inspiration, l) in zip(inspirations, lengths)]
+    inputs = makeNoteSamples(rows(m.pitches for m in melodies),
+                             rows(m.durations for m in melodies),
+                             rows(inspirationNotes),
+                             rows(m.bars for m in melodies))
+    targets = makeNoteTargets(rows((m.pitches for m in melodies), 1),
+                              rows((m.durations for m in melodies), 1))
+    return network_training.makeSequentialDataSet(inputs, targets, lengths)
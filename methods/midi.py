@@ -7,6 +7,7 @@ from mido import MidiFile
 from mido import MidiTrack
 import numpy as np
 import mido
+import midi_events
 import pdb
 
 timestepsPerBeat = 4
@@ -14,6 +15,10 @@ timestepsPerBeat = 4
 def rescaleToTimesteps(ticks_per_beat, time):
     return round((time/ticks_per_beat)*timestepsPerBeat)
 
+# Rescales an array of tick times, rounding as rescaleToTimesteps does
+def rescaleTicksToTimesteps(ticks_per_beat, times):
+    return np.round((times/ticks_per_beat)*timestepsPerBeat).astype(np.int64)
+
 def rescaleToTicks(ticks_per_beat, time):
     return round((time/timestepsPerBeat)*ticks_per_beat)
 
@@ -23,96 +28,237 @@ class Note:
     Takes the pitch (as in midi format), the start and the duration of the 
     note in timesteps
     """
+    __slots__ = ('pitch', 'start', 'duration')
+
     def __init__(self,pitch,start,duration):
         self.pitch = pitch
         self.start = start
         self.duration = duration        
 
+class TrackNote(Note):
+    """A view of a single note of a Track; reading or assigning its pitch, 
+    start or duration reads or writes the track's arrays directly."""
+    __slots__ = ('track', 'index')
+
+    def __init__(self, track, index):
+        self.track = track
+        self.index = index
+
+    @property
+    def pitch(self):
+        return int(self.track.pitches[self.index])
+
+    @pitch.setter
+    def pitch(self, pitch):
+        self.track.pitches[self.index] = pitch
+
+    @property
+    def start(self):
+        return int(self.track.starts[self.index])
+
+    @start.setter
+    def start(self, start):
+        self.track.starts[self.index] = start
+
+    @property
+    def duration(self):
+        return int(self.track.durations[self.index])
+
+    @duration.setter
+    def duration(self, duration):
+        self.track.durations[self.index] = duration
+
+class TrackNotes:
+    """The notes of a Track as a read-only sequence of TrackNote views"""
+
+    def __init__(self, track):
+        self.track = track
+
+    def __len__(self):
+        return self.track.noteCount
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [TrackNote(self.track, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('note index out of range')
+        return TrackNote(self.track, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield TrackNote(self.track, i)
+
 class Track:
+    """A sequence of notes, stored as parallel arrays of pitches, starts and 
+    durations (in timesteps). The arrays grow geometrically, so adding notes 
+    one at a time is amortised O(1); notes gives a view of them as Note 
+    objects."""
     
     def __init__(self, notes=None, barLen=np.inf):
-        self.notes = []
         self.barLen = barLen
         self.length = 0
+        self.noteCount = 0
+        self._buffer = np.zeros((3,8), dtype=np.int32)
         if not notes is None:
-            for n in notes:
-                self.addNote(n)
+            notes = list(notes)
+            self.addNotes([n.pitch for n in notes], [n.start for n in notes],
+                          [n.duration for n in notes])
+
+    @property
+    def pitches(self):
+        return self._buffer[0,:self.noteCount]
+
+    @property
+    def starts(self):
+        return self._buffer[1,:self.noteCount]
+
+    @property
+    def durations(self):
+        return self._buffer[2,:self.noteCount]
+
+    @property
+    def notes(self):
+        return TrackNotes(self)
+
+    def ends(self):
+        return self.starts + self.durations
        
     def addNote(self, note):
-        self.notes.append(note)
-        if note.start + note.duration > self.length:
-            self.length = note.start + note.duration
+        self.addNotes([note.pitch], [note.start], [note.duration])
+
+    def addNotes(self, pitches, starts, durations):
+        count = len(pitches)
+        if self.noteCount + count > self._buffer.shape[1]:
+            buffer = np.zeros((3,max(self.noteCount + count, 2*self._buffer.shape[1])), dtype=np.int32)
+            buffer[:,:self.noteCount] = self._buffer[:,:self.noteCount]
+            self._buffer = buffer
+        newNotes = self._buffer[:,self.noteCount:self.noteCount+count]
+        newNotes[0] = pitches
+        newNotes[1] = starts
+        newNotes[2] = durations
+        self.noteCount += count
+        if count > 0:
+            self.length = max(self.length, int(np.max(newNotes[1] + newNotes[2])))
+
    
     def isMonophonic(self):
-        lastEnd = 0
-        for note in self.notes:
-            if note.start < lastEnd:
-                return False
-            lastEnd = note.start + note.duration
-        return True
+        if self.noteCount == 0:
+            return True
+        ends = self.ends()
+        return bool(self.starts[0] >= 0 and not np.any(self.starts[1:] < ends[:-1]))
         
+    # Returns the proportion of the track's length during which more than one
+    # note is sounding
     def polyphonicPercentage(self):
-        polyphonicCount = 0
-        nextTime = 0
-        currentTime = 0
-        for note in self.notes:
-            endTime = max(currentTime, note.start)
-            if note.start < nextTime and note.start + note.duration > currentTime:
-                startTime = max(currentTime, note.start)
-                endTime = min(note.start + note.duration, nextTime)
-                polyphonicCount += endTime - startTime
-            nextTime = max(nextTime, note.start + note.duration)
-            currentTime = endTime
+        times = np.concatenate([self.starts, self.ends()])
+        changes = np.concatenate([np.ones(self.noteCount, dtype=int),
+                                  -np.ones(self.noteCount, dtype=int)])
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+        sounding = np.cumsum(changes[order])
+        # Keep the number of sounding notes after all events at each time
+        last = np.append(times[1:] != times[:-1], True)
+        times = times[last]
+        sounding = sounding[last]
+        polyphonicCount = int(np.sum(np.diff(times)[sounding[:-1] >= 2]))
         return polyphonicCount / self.length
     
     def uniqueNotes(self):
-        pitches = [n.pitch for n in self.notes]
-        return len(set(pitches))
-            
-        
+        return len(np.unique(self.pitches))
+
+# Makes a track from arrays of note pitches, starts and durations
+def makeTrackFromArrays(pitches, starts, durations, barLen=np.inf):
+    track = Track(barLen=barLen)
+    track.addNotes(pitches, starts, durations)
+    return track
+
+# Converts a monophonic track into per-timestep rhythm codes (0 rest, 1 note
+# start, 2 note held) and pitches (-1 where no note sounds). Timestep t is
+# assigned to the note the sequential scan would be on at t: the scan moves
+# to the next note at most once per timestep, starting at note i at
+# max(scan[i-1]+1, end[i-1]), so zero length notes are treated as before.
+def rasterizeTrack(track):
+    assert track.isMonophonic(), "Only monophonic tracks can be enscribed"
+    rhythm = np.zeros(track.length, dtype=np.int8)
+    pitches = np.full(track.length, -1, dtype=np.int8)
+    if track.length == 0:
+        return (rhythm, pitches)
+    starts = track.starts
+    ends = track.ends()
+    noteIndices = np.arange(track.noteCount)
+    lag = np.maximum.accumulate(np.concatenate([[0], ends[:-1] - noteIndices[1:]]))
+    scanStarts = noteIndices + lag
+    t = np.arange(track.length)
+    current = np.searchsorted(scanStarts, t, side='right') - 1
+    noteStarts = starts[current]
+    noteEnds = ends[current]
+    sounding = (noteStarts <= t) & (t < noteEnds)
+    rhythm[sounding] = 2
+    rhythm[t == noteStarts] = 1
+    pitches[sounding] = track.pitches[current[sounding]]
+    return (rhythm, pitches)
+
+# Rasterizes a set of tracks into single flat rhythm and pitch arrays, with
+# offsets[i]:offsets[i+1] covering track i
+def rasterizeTracks(tracks):
+    tracks = list(tracks)
+    lengths = np.array([t.length for t in tracks], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    rhythms = np.zeros(offsets[-1], dtype=np.int8)
+    pitches = np.full(offsets[-1], -1, dtype=np.int8)
+    for (i, track) in enumerate(tracks):
+        (rhythms[offsets[i]:offsets[i+1]], pitches[offsets[i]:offsets[i+1]]) = rasterizeTrack(track)
+    return (rhythms, pitches, offsets)
+
 def concatenateTracks(tracks):
     barLen = np.inf
     if len(tracks) > 0:
         barLen = tracks[0].barLen
         for t in tracks:
             if t.barLen != barLen:
-                pdb.set_trace()
-            assert t.barLen == barLen, "All concatenating tracks must have the same bar length"
+                raise ValueError("All concatenating tracks must have the same bar length")
+    offsets = np.cumsum([0] + [t.length for t in tracks[:-1]])
     trackOut = Track(barLen=barLen)
-    cumulativeTime = 0
-    for track in tracks:
-        for note in track.notes:
-            newNote = Note(note.pitch, note.start+cumulativeTime, note.duration)
-            trackOut.addNote(newNote)
-        cumulativeTime = cumulativeTime + track.length
+    if len(tracks) > 0:
+        trackOut.addNotes(np.concatenate([t.pitches for t in tracks]),
+                          np.concatenate([t.starts + offset for (t, offset) in zip(tracks, offsets)]),
+                          np.concatenate([t.durations for t in tracks]))
     return trackOut
 
 # Splits the given track into two tracks, trackA [0,splitPoint) and trackB [splitPoint,END) 
 # Preserves the original track, simply creates 2 new tracks   
 def splitTrack(track, splitPoint):
-    trackA = Track(barLen = track.barLen)
-    trackB = Track(barLen = track.barLen)
-    for n in track.notes:
-        if n.start < splitPoint:
-            if n.start + n.duration <= splitPoint:
-                trackA.addNote(Note(n.pitch, n.start, n.duration))
-            else:
-                trackA.addNote(Note(n.pitch, n.start, splitPoint - n.start))
-                trackB.addNote(Note(n.pitch, splitPoint, n.start + n.duration - splitPoint))
-        else:
-            trackB.addNote(Note(n.pitch, n.start - splitPoint, n.duration))
+    starts = track.starts
+    ends = track.ends()
+    # Notes overlapping the split point are divided between both tracks
+    inA = starts < splitPoint
+    inB = (starts >= splitPoint) | (ends > splitPoint)
+    trackA = makeTrackFromArrays(track.pitches[inA], starts[inA],
+                                 np.minimum(ends[inA], splitPoint) - starts[inA],
+                                 barLen=track.barLen)
+    startsB = np.maximum(starts[inB], splitPoint)
+    trackB = makeTrackFromArrays(track.pitches[inB], startsB - splitPoint,
+                                 ends[inB] - startsB, barLen=track.barLen)
     return (trackA,trackB)
     
     
+# Takes either a mido MidiFile or a midi_events.DecodedMidi
 def makeTrackFromMidi(mid, trackNum):
     track = Track()
-    currentTime = 0
-    lastNoteStarted = [0]*128
-    timeSignature = getMidiTimeSignature(mid)
+    timeSignatures = getMidiTimeSignature(mid)
     numerator = 4
-    if not timeSignature is None:
-        numerator = timeSignature[0][0]
+    if len(timeSignatures) > 0:
+        numerator = timeSignatures[0][0]
     track.barLen = int(timestepsPerBeat * numerator)
+    if isinstance(mid, midi_events.DecodedMidi):
+        (pitches, startTicks, endTicks) = midi_events.pairNotes(mid.tracks[trackNum])
+        track.addNotes(pitches, rescaleTicksToTimesteps(mid.ticks_per_beat, startTicks),
+                       rescaleTicksToTimesteps(mid.ticks_per_beat, endTicks - startTicks))
+        return track
+    currentTime = 0
+    lastNoteStarted = [0]*128
     for message in mid.tracks[trackNum]:
         currentTime = currentTime + message.time
         if message.type == 'note_on' or message.type == 'note_off':
@@ -183,6 +329,10 @@ def makeMidiFromTrack(track, ticksPerBeat, tempo=500000, timeSignature = (4,4,24
 # Returns the time signature of the midi, or None if the midi does not contain
 # exactly one time signature message
 def getMidiTimeSignature(mid):
+    if isinstance(mid, midi_events.DecodedMidi):
+        values = mid.events['value'][mid.events['type'] == midi_events.TIME_SIGNATURE]
+        return [(int(v >> 24), 2 ** int((v >> 16) & 0xff), int((v >> 8) & 0xff), int(v & 0xff))
+                for v in values]
     timeSignatures = []
     for track in mid.tracks:
         for message in track:
@@ -197,6 +347,8 @@ def getMidiTimeSignature(mid):
 # Returns the first listed tempo of the midi, or None if the midi does not 
 # contain a tempo message
 def getMidiTempo(mid):
+    if isinstance(mid, midi_events.DecodedMidi):
+        return mid.events['value'][mid.events['type'] == midi_events.TEMPO].tolist()
     tempos = []
     for track in mid.tracks:
         for message in track:
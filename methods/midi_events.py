@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Decodes Standard MIDI Files directly from their bytes into a compact table of
+the events used by the rest of the system
+"""
+
+import numpy as np
+import struct
+
+# Event types stored in the table; every other event is skipped
+NOTE_ON = 1
+NOTE_OFF = 2
+TEMPO = 3
+TIME_SIGNATURE = 4
+
+eventType = np.dtype([('track', np.int32),
+                      ('tick', np.int64),
+                      ('type', np.int8),
+                      ('note', np.int16),
+                      ('velocity', np.int16),
+                      ('value', np.int64)])
+
+# Number of data bytes following each channel message status (by high nibble)
+# and each system common message status
+channelDataLengths = {0x80: 2, 0x90: 2, 0xa0: 2, 0xb0: 2, 0xc0: 1, 0xd0: 1, 0xe0: 2}
+systemDataLengths = {0xf1: 1, 0xf2: 2, 0xf3: 1, 0xf6: 0, 0xf8: 0, 0xfa: 0,
+                     0xfb: 0, 0xfc: 0, 0xfe: 0}
+
+class DecodedMidi:
+    """The events of a midi file, in a single structured array ordered by
+    track and then by position within the track; tracks[i] is the view of
+    track i's events. Time signatures are stored in value as the four bytes
+    of the meta message, most significant first."""
+
+    def __init__(self, fileType, ticks_per_beat, events, trackOffsets):
+        self.type = fileType
+        self.ticks_per_beat = ticks_per_beat
+        self.events = events
+        self.trackOffsets = trackOffsets
+        self.tracks = [events[trackOffsets[i]:trackOffsets[i+1]] for i in range(len(trackOffsets)-1)]
+
+def readMidiFile(path):
+    with open(path, 'rb') as file:
+        return decodeMidi(file.read())
+
+# Decodes the bytes of a midi file, raising ValueError if they are malformed.
+# Files are read the same way as by mido: running status is followed, and
+# non-track chunks or data bytes above 127 are errors.
+def decodeMidi(data):
+    if len(data) < 8:
+        raise ValueError('file too short')
+    (name, size) = struct.unpack_from('>4sL', data, 0)
+    if name != b'MThd':
+        raise ValueError('MThd not found. Probably not a MIDI file')
+    if size < 6 or len(data) < 8 + size:
+        raise ValueError('truncated file header')
+    (fileType, trackCount, ticksPerBeat) = struct.unpack_from('>hhh', data, 8)
+    pos = 8 + size
+    events = []
+    trackOffsets = [0]
+    for trackNum in range(trackCount):
+        if len(data) < pos + 8:
+            raise ValueError('missing track {}'.format(trackNum))
+        (name, size) = struct.unpack_from('>4sL', data, pos)
+        if name != b'MTrk':
+            raise ValueError('no MTrk header at start of track')
+        pos += 8
+        end = pos + size
+        if len(data) < end:
+            raise ValueError('truncated track {}'.format(trackNum))
+        decodeTrack(data, pos, end, trackNum, events)
+        trackOffsets.append(len(events))
+        pos = end
+    return DecodedMidi(fileType, ticksPerBeat, np.array(events, dtype=eventType),
+                       np.array(trackOffsets, dtype=np.int64))
+
+# Appends the note, tempo and time signature events of the track occupying
+# data[pos:end] to events
+def decodeTrack(data, pos, end, trackNum, events):
+    tick = 0
+    lastStatus = None
+    while pos < end:
+        # Delta time as a variable length quantity
+        byte = data[pos]
+        pos += 1
+        delta = byte & 0x7f
+        while byte & 0x80:
+            byte = data[pos]
+            pos += 1
+            delta = (delta << 7) | (byte & 0x7f)
+        tick += delta
+        status = data[pos]
+        running = status < 0x80
+        if running:
+            if lastStatus is None:
+                raise ValueError('running status without last status')
+            status = lastStatus
+        else:
+            pos += 1
+            if status != 0xff:
+                lastStatus = status
+        if status == 0xff:
+            metaType = data[pos]
+            (length, pos) = readVariableInt(data, pos + 1)
+            value = data[pos:pos+length]
+            pos += length
+            if metaType == 0x51:
+                if len(value) < 3:
+                    raise ValueError('truncated tempo')
+                events.append((trackNum, tick, TEMPO, 0, 0, int.from_bytes(value[:3], 'big')))
+            elif metaType == 0x58:
+                if len(value) < 4:
+                    raise ValueError('truncated time signature')
+                events.append((trackNum, tick, TIME_SIGNATURE, 0, 0, int.from_bytes(value[:4], 'big')))
+        elif status == 0xf0 or status == 0xf7:
+            # As in mido, a data byte repeating a sysex status is dropped
+            if running:
+                pos += 1
+            (length, pos) = readVariableInt(data, pos)
+            sysex = data[pos:pos+length]
+            if sysex[:1] == b'\xf0':
+                sysex = sysex[1:]
+            if sysex[-1:] == b'\xf7':
+                sysex = sysex[:-1]
+            if len(sysex) > 0 and max(sysex) > 127:
+                raise ValueError('data byte must be in range 0..127')
+            pos += length
+        else:
+            if status < 0xf0:
+                length = channelDataLengths[status & 0xf0]
+            elif status in systemDataLengths:
+                length = systemDataLengths[status]
+            else:
+                raise ValueError('undefined status byte 0x{:02x}'.format(status))
+            if running and length == 0:
+                raise ValueError('wrong number of bytes for 0x{:02x} message'.format(status))
+            if length > 0 and max(data[pos:pos+length]) > 127:
+                raise ValueError('data byte must be in range 0..127')
+            if (status & 0xe0) == 0x80:
+                events.append((trackNum, tick, NOTE_ON if (status & 0xf0) == 0x90 else NOTE_OFF,
+                               data[pos], data[pos+1], 0))
+            pos += length
+    if pos != end:
+        raise ValueError('track {} overruns its chunk'.format(trackNum))
+
+def readVariableInt(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return (value, pos)
+
+# Pairs each note off event of a track (a note_off, or a note_on with zero
+# velocity) with the last preceding note_on of the same pitch, or with tick 0
+# if there was none. Returns the pitch, start tick and end tick of each note,
+# in the order of the note off events.
+def pairNotes(trackEvents):
+    isNote = (trackEvents['type'] == NOTE_ON) | (trackEvents['type'] == NOTE_OFF)
+    indices = np.nonzero(isNote)[0]
+    notes = trackEvents[indices]
+    isOn = (notes['type'] == NOTE_ON) & (notes['velocity'] > 0)
+    # Order the events by pitch, keeping track order within each pitch
+    order = np.lexsort((indices, notes['note']))
+    pitches = notes['note'][order]
+    onPositions = np.where(isOn[order], np.arange(len(order)), -1)
+    lastOn = np.maximum.accumulate(onPositions) if len(order) > 0 else onPositions
+    groupStarts = np.searchsorted(pitches, pitches, side='left')
+    hasStart = lastOn >= groupStarts
+    startTicks = np.where(hasStart, notes['tick'][order][np.maximum(lastOn, 0)], 0)
+    offs = ~isOn[order]
+    # Restore track order
+    trackOrder = np.argsort(indices[order][offs])
+    offNotes = notes[order][offs][trackOrder]
+    return (offNotes['note'], startTicks[offs][trackOrder], offNotes['tick'])
@@ -1,44 +1,232 @@
 # -*- coding: utf-8 -*-
 
-from mido import MidiFile
+from midi_events import readMidiFile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import Counter
 import midi
 import os
+import json
+import hashlib
 from fnmatch import fnmatch
 import pdb
 
-def isValidMidiTrack(track):
+# Returns the reason the track is unsuitable for training, or None if it is
+# suitable
+def trackRejection(track):
     if track.length == 0:
-        return False
+        return 'empty'
     if track.polyphonicPercentage() > 0.15:
-        return False
+        return 'polyphonic'
     if track.uniqueNotes() < 4:
-        return False
-    return True
+        return 'too few unique notes'
+    return None
+
+def isValidMidiTrack(track):
+    return trackRejection(track) is None
 
-def filterMidiFiles(sourceDir, targetDir):
+# Yields the path of every midi file under sourceDir
+def findMidiFiles(sourceDir):
     for dirpath, dirnames, filenames in os.walk(sourceDir):
         for filename in [f for f in filenames if fnmatch(f, '*.mid')]:
+            yield os.path.join(dirpath,filename)
+
+# Returns the stem of the output file names of each source, a path relative
+# to the source directory. Stems include the source's directory, so files of
+# the same name in different directories do not overwrite each other's
+# tracks; any stems that still clash get a hash of the source path.
+def outputStems(sources):
+    stems = [os.path.splitext(source)[0].replace(os.sep, '_') for source in sources]
+    counts = Counter(stems)
+    return [stem if counts[stem] == 1
+            else stem + '_' + hashlib.sha1(source.encode('utf-8')).hexdigest()[:8]
+            for (stem, source) in zip(stems, sources)]
+
+# Filters a single midi file, saving each of its valid tracks to targetDir as
+# outputStem-trackNum.mid, where outputStem defaults to the file's name.
+# Returns a (status, reason, outputs) tuple, where status is 'accepted',
+# 'rejected' or 'unreadable' and outputs lists the saved file names
+def filterMidiFile(path, targetDir, outputStem=None):
+    if outputStem is None:
+        outputStem = os.path.basename(path)[0:-4]
+    try:
+        mid = readMidiFile(path)
+    except Exception as e:
+        print('Cannot read file \"{}\"'.format(path))
+        return ('unreadable', 'cannot read file: {!r}'.format(e), [])
+    try:
+        timeSignatures = midi.getMidiTimeSignature(mid)
+        tempos = midi.getMidiTempo(mid)
+        if len(timeSignatures) > 1:
+            print('Midi contains multiple time signatures: \"{}\"'.format(path))
+            return ('rejected', 'multiple time signatures', [])
+        tempo = 500000
+        timeSignature = (4,4,24,8)
+        if len(tempos) > 0:
+            tempo = tempos[0]
+        if len(timeSignatures) > 0:
+            timeSignature = timeSignatures[0]
+        outputs = []
+        rejections = []
+        for trackNum in range(len(mid.tracks)):
+            track = midi.makeTrackFromMidi(mid, trackNum)
+            rejection = trackRejection(track)
+            if rejection is None:
+                trackMid = midi.makeMidiFromTrack(track, mid.ticks_per_beat, tempo, timeSignature)
+                trackMidName = outputStem + "-" + str(trackNum) + ".mid"
+                # Write via a temporary file so an interrupted run never
+                # leaves a partial track behind
+                trackMidPath = os.path.join(targetDir,trackMidName)
+                trackMid.save(trackMidPath + '.tmp')
+                os.replace(trackMidPath + '.tmp', trackMidPath)
+                outputs.append(trackMidName)
+            else:
+                rejections.append('track {}: {}'.format(trackNum, rejection))
+    except Exception as e:
+        print('Cannot process file \"{}\"'.format(path))
+        return ('unreadable', 'cannot process file: {!r}'.format(e), [])
+    if len(outputs) == 0:
+        return ('rejected', '; '.join(rejections) or 'no tracks', [])
+    return ('accepted', '{} valid tracks'.format(len(outputs)), outputs)
+
+# Filters every midi file under sourceDir, saving each valid track as a
+# separate file in targetDir, named after its source as in outputStems. Files
+# are processed in a process pool when nJobs != 1 (None uses every core).
+# Returns a manifest with an entry for each file giving its size,
+# modification time and content hash, its filter decision, the reason for it
+# and the files written; if manifestPath is given the manifest is also saved
+# there, one JSON entry per line.
+#
+# In incremental mode the manifest (by default kept in targetDir) is used to
+# skip files that are unchanged since the last run, and outputs of files that
+# have changed or been removed are cleaned up once every file is done. Entries
+# are appended to the manifest as each file finishes, so an interrupted run 
+# resumes where it stopped.
+def filterMidiFiles(sourceDir, targetDir, nJobs=1, manifestPath=None, incremental=False):
+    if incremental and manifestPath is None:
+        manifestPath = os.path.join(targetDir, 'filter-manifest.jsonl')
+    previous = {}
+    previousOutputs = set()
+    if incremental and os.path.exists(manifestPath):
+        previous = {entry['source']: entry for entry in loadManifest(manifestPath)}
+        previousOutputs = manifestOutputs(manifestPath)
+    paths = list(findMidiFiles(sourceDir))
+    sources = [os.path.relpath(path, sourceDir) for path in paths]
+    stems = outputStems(sources)
+    current = {}
+    pending = []
+    for (path, source, stem) in zip(paths, sources, stems):
+        entry = unchangedEntry(path, previous.get(source))
+        if entry is None:
+            pending.append((path, stem))
+        else:
+            current[source] = entry
+    journal = None
+    if not manifestPath is None:
+        journal = open(manifestPath, 'a' if incremental else 'w')
+    try:
+        if nJobs == 1:
+            results = (filterManifestEntry(path, sourceDir, targetDir, stem)
+                       for (path, stem) in pending)
+            recordEntries(results, current, journal)
+        else:
+            with ProcessPoolExecutor(nJobs) as executor:
+                futures = [executor.submit(filterManifestEntry, path, sourceDir, targetDir, stem)
+                           for (path, stem) in pending]
+                # Entries are journaled in the order files finish, so a slow
+                # file does not hold back the ones after it
+                results = (future.result() for future in as_completed(futures))
+                recordEntries(results, current, journal)
+    finally:
+        if not journal is None:
+            journal.close()
+    manifest = [current[source] for source in sources]
+    # Outputs recorded in earlier runs are removed unless a current entry
+    # claims the same file
+    claimed = set(output for entry in manifest for output in entry['outputs'])
+    removeOutputs(targetDir, previousOutputs - claimed)
+    if not manifestPath is None:
+        # Replace the journal with a compacted manifest
+        saveManifest(manifest, manifestPath + '.tmp')
+        os.replace(manifestPath + '.tmp', manifestPath)
+    counts = {status: 0 for status in ('accepted', 'rejected', 'unreadable')}
+    for entry in manifest:
+        counts[entry['status']] += 1
+    print('Accepted {accepted}, rejected {rejected}, unreadable {unreadable}'.format(**counts) +
+          ' ({} files processed, {} unchanged)'.format(len(pending), len(paths) - len(pending)))
+    return manifest
+
+# Filters a single file and returns its manifest entry
+def filterManifestEntry(path, sourceDir, targetDir, outputStem=None):
+    entry = {'source': os.path.relpath(path, sourceDir)}
+    entry.update(fileFingerprint(path))
+    (entry['status'], entry['reason'], entry['outputs']) = filterMidiFile(path, targetDir,
+                                                                          outputStem)
+    return entry
+
+def recordEntries(entries, current, journal):
+    for entry in entries:
+        current[entry['source']] = entry
+        if not journal is None:
+            journal.write(json.dumps(entry) + '\n')
+            journal.flush()
+
+def removeOutputs(targetDir, outputs):
+    for output in outputs:
+        path = os.path.join(targetDir, output)
+        if os.path.exists(path):
+            os.remove(path)
+
+# Returns the size, modification time and content hash of a file
+def fileFingerprint(path):
+    with open(path, 'rb') as file:
+        digest = hashlib.sha1(file.read()).hexdigest()
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': digest}
+
+# Returns the entry for a file if the file has not changed since the entry
+# was recorded, or None otherwise. Files whose modification time has changed
+# are compared by content hash
+def unchangedEntry(path, entry):
+    if entry is None or not 'hash' in entry:
+        return None
+    stat = os.stat(path)
+    if stat.st_size != entry['size']:
+        return None
+    if stat.st_mtime == entry['mtime']:
+        return entry
+    fingerprint = fileFingerprint(path)
+    if fingerprint['hash'] != entry['hash']:
+        return None
+    entry = dict(entry)
+    entry.update(fingerprint)
+    return entry
+
+def saveManifest(manifest, manifestPath):
+    with open(manifestPath, 'w') as file:
+        for entry in manifest:
+            file.write(json.dumps(entry) + '\n')
+
+# Loads a manifest, with later entries for a file replacing earlier ones
+def loadManifest(manifestPath):
+    entries = {}
+    for entry in readManifestEntries(manifestPath):
+        entries[entry['source']] = entry
+    return list(entries.values())
+
+# Returns every output a manifest records, including those of entries that
+# later entries replace, such as the outputs an interrupted run has not yet
+# cleaned up
+def manifestOutputs(manifestPath):
+    return set(output for entry in readManifestEntries(manifestPath)
+               for output in entry['outputs'])
+
+# Yields each entry of a manifest in turn. A truncated final line, left by an
+# interrupted run, is ignored
+def readManifestEntries(manifestPath):
+    with open(manifestPath) as file:
+        for line in file:
             try:
-                mid = MidiFile(os.path.join(dirpath,filename))
-            except:
-                print('Cannot read file \"{}\"'.format(os.path.join(dirpath,filename)))
+                entry = json.loads(line)
+            except ValueError:
                 continue
-            timeSignatures = midi.getMidiTimeSignature(mid)
-            tempos = midi.getMidiTempo(mid)
-            if len(timeSignatures) > 1:
-                print('Midi contains multiple time signatures: \"{}\"'.format(os.path.join(dirpath,filename)))
-                continue
-            tempo = 500000
-            timeSignature = (4,4,24,8)
-            if len(tempos) > 0:
-                tempo = tempos[0]
-            if len(timeSignatures) > 0:
-                timeSignature = timeSignatures[0]
-            for trackNum in range(len(mid.tracks)):
-                track = midi.makeTrackFromMidi(mid, trackNum)
-                if isValidMidiTrack(track):
-                    trackMid = midi.makeMidiFromTrack(track, mid.ticks_per_beat, tempo, timeSignature)
-                    trackMidName = filename[0:-4] + "-" + str(trackNum) + ".mid"
-                    trackMid.save(os.path.join(targetDir,trackMidName))
-                            
-
+            yield entry
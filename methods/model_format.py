@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+A versioned model file format holding only the numeric state of a trained
+generator, as uncompressed arrays in an npz file, so that models load
+without unpickling pybrain or hmmlearn objects
+"""
+
+from network_training import NetworkWeights, networkArchitecture
+from xml.etree import ElementTree
+import numpy as np
+import os
+
+# Files record the schema version they were written with and the kind of
+# model they hold; loading checks both
+schemaVersion = 1
+
+# Saves a dict of arrays (or scalars) as a model of the given kind, replacing
+# filename only once the file is complete
+def saveModel(filename, kind, arrays):
+    with open(filename + '.tmp', 'wb') as file:
+        np.savez(file, schemaVersion=np.array(schemaVersion), kind=np.array(kind), **arrays)
+    os.replace(filename + '.tmp', filename)
+
+# Returns the arrays of a model file, raising ValueError if it was written
+# with another schema version or holds a different kind of model
+def loadModel(filename, kind):
+    with np.load(filename, allow_pickle=False) as data:
+        if not 'schemaVersion' in data.files:
+            raise ValueError('{} is not a model file'.format(filename))
+        if int(data['schemaVersion']) != schemaVersion:
+            raise ValueError('{} has schema version {}, but only version {} is supported'.format(
+                filename, int(data['schemaVersion']), schemaVersion))
+        if str(data['kind']) != kind:
+            raise ValueError('{} holds a {} model, not a {} model'.format(
+                filename, str(data['kind']), kind))
+        return {name: data[name] for name in data.files}
+
+# Returns the weights of a Todd or Elman network as model arrays
+def networkArrays(net):
+    weights = NetworkWeights(net)
+    return {'net_architecture': np.array(weights.architecture),
+            'net_inWeights': weights.inWeights,
+            'net_outWeights': weights.outWeights,
+            'net_feedback': np.array(weights.feedback)}
+
+# Rebuilds the network stored in model arrays, where build is the function
+# that builds a network of its architecture from the hidden, input and output
+# layer sizes
+def restoreNetwork(arrays, build):
+    (hiddenSize, inSize) = arrays['net_inWeights'].shape
+    net = build(hiddenSize, inSize, arrays['net_outWeights'].shape[0])
+    architecture = str(arrays['net_architecture'])
+    if networkArchitecture(net) != architecture:
+        raise ValueError('Cannot rebuild a {} network with {}'.format(architecture, build.__name__))
+    if architecture == 'todd':
+        net.recurrentConns[0].weight = float(arrays['net_feedback'])
+    weights = NetworkWeights(net)
+    weights.inWeights = arrays['net_inWeights']
+    weights.outWeights = arrays['net_outWeights']
+    weights.writeBack(net)
+    return net
+
+# Reads an Elman network saved by pybrain's NetworkWriter into model arrays,
+# without pybrain. Raises ValueError for any other network structure.
+def readXmlNetworkArrays(xmlPath):
+    network = ElementTree.parse(xmlPath).getroot().find('Network')
+    modules = {m.get('name'): m for m in network.find('Modules')}
+    if len(modules) != 3 or any(m.tag != 'LinearLayer' and m.tag != 'SigmoidLayer'
+                                for m in modules.values()):
+        raise ValueError('Only Elman networks can be converted from xml')
+    inLayer = [name for (name, m) in modules.items() if m.get('inmodule') == 'True'][0]
+    outLayer = [name for (name, m) in modules.items() if m.get('outmodule') == 'True'][0]
+    hiddenLayer = [name for name in modules if name != inLayer and name != outLayer][0]
+    connections = {}
+    for c in network.find('Connections'):
+        ends = (c.find('inmod').get('val'), c.find('outmod').get('val'))
+        connections[ends] = c
+    inToHidden = connections.get((inLayer, hiddenLayer))
+    hiddenToOut = connections.get((hiddenLayer, outLayer))
+    recurrent = connections.get((hiddenLayer, hiddenLayer))
+    if len(connections) != 3 or inToHidden is None or hiddenToOut is None or recurrent is None \
+       or inToHidden.tag != 'FullConnection' or hiddenToOut.tag != 'FullConnection' \
+       or recurrent.tag != 'IdentityConnection':
+        raise ValueError('Only Elman networks can be converted from xml')
+    dim = lambda name: int(modules[name].find('dim').get('val'))
+    return {'net_architecture': np.array('elman'),
+            'net_inWeights': xmlParameters(inToHidden).reshape(dim(hiddenLayer), dim(inLayer)),
+            'net_outWeights': xmlParameters(hiddenToOut).reshape(dim(outLayer), dim(hiddenLayer)),
+            'net_feedback': np.array(1.0)}
+
+def xmlParameters(connection):
+    text = connection.find('Parameters').text.strip()
+    return np.array(text[1:-1].split(','), dtype=np.float64)
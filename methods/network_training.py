@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Trains the Todd and Elman melody networks with NumPy instead of pybrain's
+per-sample module code, writing the learned weights back into the network
+"""
+
+from pybrain.structure import FullConnection, IdentityConnection
+from pybrain.datasets.sequential import SequentialDataSet
+from pybrain.tools.functions import sigmoid
+from scipy.signal import lfilter
+from random import shuffle
+import numpy as np
+
+class NetworkWeights:
+    """The weights of a three layer network built by todd_ann.buildToddNetwork
+    or melody_model.buildElmanNetwork. architecture is 'todd' if the input
+    layer feeds its weighted previous input back into itself, or 'elman' if
+    the hidden layer feeds its previous output back into its input."""
+
+    def __init__(self, net):
+        self.architecture = networkArchitecture(net)
+        if self.architecture is None:
+            raise ValueError('Only Todd and Elman networks can be trained with NumPy; '
+                             'use the pybrain backend for other networks')
+        inLayer = net.inmodules[0]
+        self.inToHidden = [c for c in net.connections[inLayer] if isinstance(c, FullConnection)][0]
+        self.hiddenToOut = [c for c in net.connections[self.inToHidden.outmod]
+                            if isinstance(c, FullConnection)][0]
+        self.inWeights = self.inToHidden.params.reshape(self.inToHidden.outdim, self.inToHidden.indim).copy()
+        self.outWeights = self.hiddenToOut.params.reshape(self.hiddenToOut.outdim, self.hiddenToOut.indim).copy()
+        self.feedback = getattr(net.recurrentConns[0], 'weight', 1.0)
+
+    # Copies the weights into the network's connections
+    def writeBack(self, net):
+        self.inToHidden.params[:] = self.inWeights.ravel()
+        self.hiddenToOut.params[:] = self.outWeights.ravel()
+        net.reset()
+
+# Returns 'todd' or 'elman' for networks of exactly those structures, or None
+def networkArchitecture(net):
+    if len(net.modules) != 3 or len(net.recurrentConns) != 1 or len(net.inmodules) != 1:
+        return None
+    inLayer = net.inmodules[0]
+    outLayer = net.outmodules[0]
+    forward = [c for m in net.modules for c in net.connections[m]]
+    if len(forward) != 2 or not all(isinstance(c, FullConnection) for c in forward):
+        return None
+    inToHidden = [c for c in forward if c.inmod is inLayer]
+    if len(inToHidden) != 1:
+        return None
+    hiddenLayer = inToHidden[0].outmod
+    if not any(c.inmod is hiddenLayer and c.outmod is outLayer for c in forward):
+        return None
+    recurrent = net.recurrentConns[0]
+    if recurrent.inmod is inLayer and recurrent.outmod is inLayer and hasattr(recurrent, 'weight'):
+        return 'todd'
+    if isinstance(recurrent, IdentityConnection) and recurrent.inmod is hiddenLayer \
+       and recurrent.outmod is hiddenLayer:
+        return 'elman'
+    return None
+
+# Returns the start and end of each sequence of a SequentialDataSet
+def sequenceBounds(ds):
+    starts = np.ravel(ds['sequence_index']).astype(np.int64)
+    ends = np.append(starts[1:], len(ds))
+    return (starts, ends)
+
+# Builds a SequentialDataSet from arrays of input and target rows, divided
+# into consecutive sequences of the given lengths, setting each field at once
+# rather than adding samples one by one. Empty sequences are dropped, as 
+# SequentialDataSet does not allow them.
+def makeSequentialDataSet(inputs, targets, lengths):
+    ds = SequentialDataSet(inputs.shape[1], targets.shape[1])
+    lengths = np.asarray(lengths, dtype=np.int64)
+    starts = (np.cumsum(lengths) - lengths)[lengths > 0]
+    if len(starts) == 0:
+        starts = np.zeros(1, dtype=np.int64)
+    ds.setField('input', inputs)
+    ds.setField('target', targets)
+    ds.setField('sequence_index', starts.reshape(-1,1))
+    return ds
+
+# Gathers a set of sequences into (sequence, timestep, value) arrays padded
+# with zeros to the longest, along with a mask of the real timesteps
+def padSequences(inputs, targets, starts, ends):
+    lengths = ends - starts
+    steps = np.arange(max(int(np.max(lengths)), 1))
+    mask = steps[None,:] < lengths[:,None]
+    indices = np.where(mask, starts[:,None] + steps[None,:], 0)
+    return (inputs[indices] * mask[:,:,None], targets[indices] * mask[:,:,None], mask)
+
+# Trains a Todd or Elman network on a SequentialDataSet with the same update
+# rule as pybrain's BackpropTrainer: in each epoch the sequences are shuffled
+# and, after each minibatch of batchSize sequences, the parameters move by
+# momentum plus learningrate times the summed gradient less weightdecay
+# times the parameters. With batchSize 1 this is the trainer's per-sequence
+# update. Elman networks are trained by backpropagation through time; if
+# truncation is given, errors are propagated back within consecutive windows
+# of that many timesteps only. Todd networks have no weights in their
+# recurrence, so their gradient is exact without it.
+def trainNetwork(net, ds, epochs, learningrate=0.01, momentum=0.0, weightdecay=0.0,
+                 batchSize=1, truncation=None):
+    assert len(ds) > 0, "Dataset cannot be empty."
+    weights = NetworkWeights(net)
+    inputs = np.asarray(ds['input'], dtype=np.float64)
+    targets = np.asarray(ds['target'], dtype=np.float64)
+    (starts, ends) = sequenceBounds(ds)
+    if weights.architecture == 'todd':
+        gradient = lambda X, Y, mask: toddGradient(weights, X, Y, mask)
+    else:
+        gradient = lambda X, Y, mask: elmanGradient(weights, X, Y, mask, truncation)
+    inMomentum = np.zeros_like(weights.inWeights)
+    outMomentum = np.zeros_like(weights.outWeights)
+    for epoch in range(epochs):
+        order = list(range(len(starts)))
+        shuffle(order)
+        for b in range(0, len(order), batchSize):
+            batch = np.array(order[b:b+batchSize])
+            (X, Y, mask) = padSequences(inputs, targets, starts[batch], ends[batch])
+            (inDerivs, outDerivs) = gradient(X, Y, mask)
+            inMomentum *= momentum
+            inMomentum += learningrate * (inDerivs - weightdecay * weights.inWeights)
+            outMomentum *= momentum
+            outMomentum += learningrate * (outDerivs - weightdecay * weights.outWeights)
+            weights.inWeights += inMomentum
+            weights.outWeights += outMomentum
+    weights.writeBack(net)
+
+# Returns the derivatives of the negative squared error with respect to the
+# input and output weights of a Todd network over a padded batch
+def toddGradient(weights, X, Y, mask):
+    states = lfilter([1.0], [1.0, -weights.feedback], X, axis=1)
+    hidden = sigmoid(np.dot(states, weights.inWeights.T))
+    out = sigmoid(np.dot(hidden, weights.outWeights.T))
+    outDeltas = (Y - out) * out * (1 - out) * mask[:,:,None]
+    hiddenDeltas = np.dot(outDeltas, weights.outWeights) * hidden * (1 - hidden)
+    outDerivs = np.tensordot(outDeltas, hidden, axes=([0,1],[0,1]))
+    inDerivs = np.tensordot(hiddenDeltas, states, axes=([0,1],[0,1]))
+    return (inDerivs, outDerivs)
+
+# As toddGradient for an Elman network, whose hidden layer adds its previous
+# output to its input
+def elmanGradient(weights, X, Y, mask, truncation=None):
+    (batchCount, stepCount, _) = X.shape
+    hiddenInputs = np.dot(X, weights.inWeights.T)
+    hidden = np.zeros_like(hiddenInputs)
+    for t in range(stepCount):
+        if t > 0:
+            hiddenInputs[:,t] += hidden[:,t-1]
+        hidden[:,t] = sigmoid(hiddenInputs[:,t])
+    out = sigmoid(np.dot(hidden, weights.outWeights.T))
+    outDeltas = (Y - out) * out * (1 - out) * mask[:,:,None]
+    hiddenErrors = np.dot(outDeltas, weights.outWeights)
+    hiddenDeltas = np.zeros_like(hidden)
+    carried = np.zeros((batchCount, hidden.shape[2]))
+    for t in range(stepCount-1, -1, -1):
+        hiddenDeltas[:,t] = (hiddenErrors[:,t] + carried) * hidden[:,t] * (1 - hidden[:,t]) * mask[:,t,None]
+        carried = hiddenDeltas[:,t]
+        if not truncation is None and t % truncation == 0:
+            carried = np.zeros_like(carried)
+    outDerivs = np.tensordot(outDeltas, hidden, axes=([0,1],[0,1]))
+    inDerivs = np.tensordot(hiddenDeltas, X, axes=([0,1],[0,1]))
+    return (inDerivs, outDerivs)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for sharing large read-only arrays with worker processes
+"""
+
+import numpy as np
+import os
+import shutil
+import tempfile
+
+class SharedArrays:
+    """Writes a set of named arrays to a temporary directory so that worker 
+    processes can memory-map them read-only instead of each receiving a 
+    pickled copy. Use as a context manager, or call close() when done."""
+
+    def __init__(self, **arrays):
+        self.directory = tempfile.mkdtemp(prefix='shared-arrays-')
+        self.paths = {}
+        for name, array in arrays.items():
+            path = os.path.join(self.directory, name + '.npy')
+            np.save(path, np.ascontiguousarray(array))
+            self.paths[name] = path
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Maps the arrays written by a SharedArrays object, given its paths
+def loadSharedArrays(paths):
+    return {name: np.load(path, mmap_mode='r') for name, path in paths.items()}
@@ -3,49 +3,286 @@
 An HMM for predicting rhythmic sequences in music
 """
 from hmmlearn.hmm import MultinomialHMM
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from copy import deepcopy
+from parallel import SharedArrays, loadSharedArrays
+import multiprocessing
+import hashlib
+import midi
 import numpy as np
+import time
 
 class Rhythm:
+    """A sequence of rhythm codes (0 rest, 1 note start, 2 note held), stored 
+    in a growable int8 buffer so that appending is amortised O(1)."""
     
     def __init__(self):
-        self.timesteps = np.array([])
+        self._buffer = np.zeros(16, dtype=np.int8)
+        self._length = 0
+
+    @property
+    def timesteps(self):
+        return self._buffer[:self._length]
+
+    @timesteps.setter
+    def timesteps(self, timesteps):
+        self._buffer = np.array(timesteps, dtype=np.int8).reshape(-1)
+        self._length = len(self._buffer)
 
     def addTimestep(self, note):
-        self.timesteps = np.append(self.timesteps, note).astype(np.int32)
+        self._reserve(self._length + 1)
+        self._buffer[self._length] = note
+        self._length += 1
+
+    def extend(self, notes):
+        notes = np.asarray(notes, dtype=np.int8).reshape(-1)
+        self._reserve(self._length + len(notes))
+        self._buffer[self._length:self._length+len(notes)] = notes
+        self._length += len(notes)
             
     def length(self):
-        return len(self.timesteps)
+        return self._length
+
+    # Grows the buffer geometrically to hold at least the given number of
+    # timesteps
+    def _reserve(self, size):
+        if size > len(self._buffer):
+            buffer = np.zeros(max(size, 2*len(self._buffer)), dtype=np.int8)
+            buffer[:self._length] = self.timesteps
+            self._buffer = buffer
 
 def makeTrackRhythm(track):
-    assert track.isMonophonic(), "Only monophonic tracks can be enscribed"
     rhythm = Rhythm()
-    rhythm.timesteps = [0]*track.length
-    noteStart = 0
-    noteEnd = 0
-    n = -1
-    for t in range(track.length):
-        if noteEnd <= t:
-            n = n + 1
-            noteStart = track.notes[n].start
-            noteEnd = track.notes[n].start + track.notes[n].duration
-        if t == noteStart:
-            rhythm.timesteps[t] = 1
-        elif noteStart < t and t < noteEnd:
-            rhythm.timesteps[t] = 2
+    (rhythm.timesteps, _) = midi.rasterizeTrack(track)
     return rhythm
 
+# Concatenates rhythms into a single sample array for the HMM, along with
+# the length of each rhythm; the array is sized once and filled in place
 def makeRhythmSamples(rhythms):
-    samples = np.array([]).astype(np.int32)
-    lengths = np.array([]).astype(np.int32)
-    for r in rhythms:
-        samples = np.concatenate((samples, r.timesteps))
-        lengths = np.append(lengths, len(r.timesteps))
+    lengths = np.array([r.length() for r in rhythms], dtype=np.int32)
+    samples = np.zeros(np.sum(lengths), dtype=np.int32)
+    end = 0
+    for (r, length) in zip(rhythms, lengths):
+        samples[end:end+length] = r.timesteps
+        end += length
     samples = samples.reshape(-1,1)
     return (samples,lengths)
 
+# Returns the forward messages of a sequence of symbols, each normalised to 
+# sum to 1, along with the log of each normalising factor; the factors sum to
+# the sequence's log likelihood
+def forwardMessages(hmm, symbols, startProbs=None):
+    if startProbs is None:
+        startProbs = hmm.startprob_
+    messages = np.zeros((len(symbols),len(startProbs)))
+    logScales = np.zeros(len(symbols))
+    message = startProbs * hmm.emissionprob_[:,symbols[0]]
+    for t in range(len(symbols)):
+        if t > 0:
+            message = np.dot(messages[t-1], hmm.transmat_) * hmm.emissionprob_[:,symbols[t]]
+        scale = np.sum(message)
+        messages[t] = message / scale
+        logScales[t] = np.log(scale)
+    return (messages, logScales)
+
+# Forward and backward messages for a set of equal length symbol sequences,
+# indexed by [sequence, ...] and normalised as in forwardMessages; in
+# batchBackwardMessages, logScales[:,t] is the total log scaling applied to
+# message t. They use einsum, whose results for each sequence do not depend
+# on the rest of the batch.
+def batchForwardStart(hmm, startProbs, symbols):
+    message = startProbs * hmm.emissionprob_[:,symbols].T
+    scale = np.sum(message, axis=1)
+    return (message / scale[:,None], np.log(scale))
+
+def batchForwardStep(hmm, messages, symbols):
+    message = np.einsum('bs,st->bt', messages, hmm.transmat_) * hmm.emissionprob_[:,symbols].T
+    scale = np.sum(message, axis=1)
+    return (message / scale[:,None], np.log(scale))
+
+def batchBackwardMessages(hmm, symbols):
+    (sequenceCount, length) = symbols.shape
+    messages = np.ones((sequenceCount,length,hmm.transmat_.shape[0]))
+    logScales = np.zeros((sequenceCount,length))
+    for t in range(length-2,-1,-1):
+        message = np.einsum('st,bt->bs', hmm.transmat_,
+                            hmm.emissionprob_[:,symbols[:,t+1]].T * messages[:,t+1])
+        scale = np.sum(message, axis=1)
+        messages[:,t] = message / scale[:,None]
+        logScales[:,t] = logScales[:,t+1] + np.log(scale)
+    return (messages, logScales)
+
+class RhythmHMMSession:
+    """The filtered state distribution of an HMM after a rhythm, kept as the
+    normalised forward message at the end of the rhythm so that the rhythm 
+    can be extended without processing it again. length is the number of 
+    symbols seen and logLikelihood their log likelihood."""
+
+    def __init__(self, hmm, rhythm=None):
+        self.hmm = hmm
+        self.message = None
+        self.length = 0
+        self.logLikelihood = 0.0
+        if not rhythm is None:
+            self.extend(rhythm)
+
+    # Advances the message over a sequence of further symbols
+    def extend(self, symbols):
+        symbols = np.asarray(symbols).reshape(-1)
+        if len(symbols) == 0:
+            return
+        if self.length == 0:
+            startProbs = self.hmm.startprob_
+        else:
+            startProbs = np.dot(self.message, self.hmm.transmat_)
+        (messages, logScales) = forwardMessages(self.hmm, symbols, startProbs)
+        self.message = messages[-1]
+        self.length += len(symbols)
+        self.logLikelihood += np.sum(logScales)
+
+    # Returns the distribution of the state at the last symbol, the same as 
+    # the last row of hmm.predict_proba over the whole rhythm; before any 
+    # symbols this is the start distribution
+    def stateProbs(self):
+        if self.length == 0:
+            return np.array(self.hmm.startprob_, dtype=np.float64)
+        return self.message.copy()
+
+    # Returns the session as a dict of plain values that can be saved as JSON
+    # and passed to restoreRhythmHMMSession
+    def getState(self):
+        return {'fingerprint': hmmFingerprint(self.hmm),
+                'length': int(self.length),
+                'logLikelihood': float(self.logLikelihood),
+                'message': None if self.message is None else self.message.tolist()}
+
+# Recreates a session saved by getState, raising ValueError if the state was
+# saved with a different HMM
+def restoreRhythmHMMSession(hmm, state):
+    if state['fingerprint'] != hmmFingerprint(hmm):
+        raise ValueError('Session was saved with a different HMM')
+    session = RhythmHMMSession(hmm)
+    session.length = state['length']
+    session.logLikelihood = state['logLikelihood']
+    if not state['message'] is None:
+        session.message = np.array(state['message'], dtype=np.float64)
+    return session
+
+# Hashes an HMM's parameters, identifying the model a session belongs to
+def hmmFingerprint(hmm):
+    digest = hashlib.sha1()
+    for params in (hmm.startprob_, hmm.transmat_, hmm.emissionprob_):
+        params = np.ascontiguousarray(params, dtype=np.float64)
+        digest.update(str(params.shape).encode('utf-8'))
+        digest.update(params.tobytes())
+    return digest.hexdigest()
+
 def buildHMM(num_states, n_iter=10, tol=0.01):
     model = MultinomialHMM(n_components=num_states, n_iter=n_iter, tol=tol)
     model.n_features = 3
     return model
 
 
+
+# Fits several independently initialised copies of hmm to the samples and
+# returns the one with the highest log likelihood, along with a list of
+# (restart, score, seconds, pruned) tuples describing every restart. Each
+# restart is seeded from seed so that results are reproducible, and restarts
+# run in a process pool when nJobs != 1 (None uses every core). If
+# pruneMargin is given, a restart is checked every pruneInterval iterations
+# and abandoned once its log likelihood trails the best any restart had
+# reached after as many iterations by more than pruneMargin; a finished
+# restart's final score counts for every check after it converged. Pruning
+# is still a heuristic: a restart that starts slowly and would have overtaken
+# the others can be abandoned.
+def fitHMMRestarts(hmm, samples, lengths, restarts, nJobs=1, seed=None,
+                   pruneMargin=None, pruneInterval=50):
+    randomState = np.random if seed is None else np.random.RandomState(seed)
+    restartSeeds = randomState.randint(2**31 - 1, size=restarts)
+    results = [None]*restarts
+    # The best score at each check, shared by every restart
+    checkCount = max(-(-hmm.n_iter // pruneInterval), 1)
+    bestScores = multiprocessing.Array('d', [-np.inf]*checkCount)
+    if nJobs == 1:
+        for r in range(restarts):
+            results[r] = _fitRestart(hmm, samples, lengths, r, restartSeeds[r],
+                                     pruneMargin, pruneInterval, bestScores)
+    else:
+        with SharedArrays(samples=samples, lengths=lengths) as shared:
+            with ProcessPoolExecutor(nJobs, initializer=_initRestartWorker,
+                                     initargs=(shared.paths, bestScores)) as executor:
+                futures = [executor.submit(_fitSharedRestart, hmm, r, restartSeeds[r],
+                                           pruneMargin, pruneInterval)
+                           for r in range(restarts)]
+                for future in as_completed(futures):
+                    result = future.result()
+                    results[result[0]] = result
+    bestHMM = hmm
+    bestScore = -np.inf
+    for (r, model, score, seconds, pruned) in results:
+        if not pruned and score > bestScore:
+            bestHMM = model
+            bestScore = score
+    reports = [(r, score, seconds, pruned) for (r, model, score, seconds, pruned) in results]
+    return (bestHMM, reports)
+
+# Fits one restart; bestScores holds the best score of any restart at each
+# check, used for pruning
+def _fitRestart(hmm, samples, lengths, restart, seed, pruneMargin, pruneInterval, bestScores):
+    start = time.perf_counter()
+    model = deepcopy(hmm)
+    model.random_state = seed
+    pruned = False
+    if pruneMargin is None:
+        model.fit(samples, lengths)
+        score = model.score(samples, lengths)
+    else:
+        # Fit in chunks of iterations, continuing from the current parameters
+        # after the first chunk
+        totalIters = model.n_iter
+        initParams = model.init_params
+        iters = 0
+        check = 0
+        while iters < totalIters:
+            model.n_iter = min(pruneInterval, totalIters - iters)
+            model.fit(samples, lengths)
+            model.init_params = ''
+            iters += model.n_iter
+            history = model.monitor_.history
+            converged = (len(history) >= 2 and history[-1] - history[-2] < model.tol)
+            if converged or iters >= totalIters:
+                break
+            # Restarts are compared after the same number of iterations
+            if history[-1] + pruneMargin < _recordScores(bestScores, check, check+1, history[-1]):
+                pruned = True
+                break
+            check += 1
+        model.n_iter = totalIters
+        model.init_params = initParams
+        score = model.monitor_.history[-1] if pruned else model.score(samples, lengths)
+        if not pruned:
+            _recordScores(bestScores, check, len(bestScores), score)
+    return (restart, model, score, time.perf_counter() - start, pruned)
+
+# Raises the best scores of checks start to end to at least score, returning
+# the best score of the first of them
+def _recordScores(bestScores, start, end, score):
+    with bestScores.get_lock():
+        for c in range(start, end):
+            bestScores[c] = max(bestScores[c], score)
+        return bestScores[start]
+
+_restartSamples = None
+_restartLengths = None
+_restartBest = None
+
+def _initRestartWorker(paths, bestScores):
+    global _restartSamples, _restartLengths, _restartBest
+    shared = loadSharedArrays(paths)
+    _restartSamples = shared['samples']
+    _restartLengths = shared['lengths']
+    _restartBest = bestScores
+
+def _fitSharedRestart(hmm, restart, seed, pruneMargin, pruneInterval):
+    return _fitRestart(hmm, _restartSamples, _restartLengths, restart, seed,
+                       pruneMargin, pruneInterval, _restartBest)
@@ -7,25 +7,155 @@ melody processing
 import rhythm_hmm as rh
 import long_rhythm_distance as lrd
 import todd_ann as mel
+import model_format
 import numpy as np
+import itertools
 import midi
+import os
 import time
-from copy import deepcopy
 import pdb
 import pickle
 
+class TrackCorpus:
+    """The rhythm codes, pitches and new note flags of a set of tracks, each 
+    concatenated into a single flat array, with trackOffsets giving where 
+    each track starts.
+    
+    Tracks are added a batch at a time, so only one batch needs to be held 
+    in memory while a corpus is built from a stream. If a directory is given the 
+    arrays are appended to files there and memory-mapped once finish() is 
+    called; otherwise they are collected in memory. barLens holds each 
+    track's bar length."""
+    
+    fields = (('rhythms', np.int8), ('pitches', np.int8), ('newNotes', np.int8))
+    
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.trackLengths = []
+        self.barLens = []
+        self.chunks = {name: [] for (name, _) in self.fields}
+        self.files = {}
+        if not directory is None:
+            self.files = {name: open(self.fieldPath(name), 'wb') for (name, _) in self.fields}
+    
+    def fieldPath(self, name):
+        return os.path.join(self.directory, name + '.bin')
+    
+    def addTrack(self, track):
+        self.addTracks([track])
+    
+    # Adds a batch of tracks, rasterized together into flat arrays
+    def addTracks(self, tracks):
+        tracks = list(tracks)
+        (rhythms, pitches, offsets) = midi.rasterizeTracks(tracks)
+        values = {'rhythms': rhythms,
+                  'pitches': np.where(pitches >= 0, pitches % mel.pitchCount, mel.nonPitch),
+                  'newNotes': rhythms == 1}
+        for (name, dtype) in self.fields:
+            array = np.asarray(values[name], dtype=dtype)
+            if self.directory is None:
+                self.chunks[name].append(array)
+            else:
+                self.files[name].write(array.tobytes())
+        self.trackLengths.extend(np.diff(offsets))
+        self.barLens.extend(t.barLen for t in tracks)
+    
+    # Adds every track of an iterable, batchSize tracks at a time
+    def addStream(self, tracks, batchSize=64):
+        tracks = iter(tracks)
+        while True:
+            batch = list(itertools.islice(tracks, batchSize))
+            if len(batch) == 0:
+                break
+            self.addTracks(batch)
+    
+    # Completes the corpus, making the field arrays available
+    def finish(self):
+        self.trackLengths = np.array(self.trackLengths, dtype=np.int64)
+        self.barLens = np.array(self.barLens, dtype=np.float64)
+        self.trackOffsets = np.concatenate([[0], np.cumsum(self.trackLengths)])
+        total = self.trackOffsets[-1]
+        for (name, dtype) in self.fields:
+            if self.directory is None:
+                array = np.concatenate(self.chunks[name]) if total > 0 else np.zeros(0, dtype=dtype)
+            else:
+                self.files[name].close()
+                if total > 0:
+                    array = np.memmap(self.fieldPath(name), dtype=dtype, mode='r', shape=(total,))
+                else:
+                    array = np.zeros(0, dtype=dtype)
+            setattr(self, name, array)
+        self.chunks = None
+        self.files = None
+    
+    def trackCount(self):
+        return len(self.trackLengths)
+    
+    # Returns views of the given field for each track
+    def trackSlices(self, name):
+        array = getattr(self, name)
+        return [array[self.trackOffsets[i]:self.trackOffsets[i+1]] for i in range(self.trackCount())]
+    
+    # Yields each track's melody in turn
+    def melodies(self):
+        for (pitches, newNotes) in zip(self.trackSlices('pitches'), self.trackSlices('newNotes')):
+            melody = mel.Melody()
+            melody.pitches = pitches
+            melody.newNotes = newNotes
+            yield melody
+
+# Makes a finished corpus from existing field arrays, such as those of a 
+# corpus cache
+def makeTrackCorpusFromArrays(rhythms, pitches, newNotes, trackOffsets, barLens):
+    corpus = TrackCorpus()
+    corpus.rhythms = rhythms
+    corpus.pitches = pitches
+    corpus.newNotes = newNotes
+    corpus.trackOffsets = np.asarray(trackOffsets, dtype=np.int64)
+    corpus.trackLengths = np.diff(corpus.trackOffsets)
+    corpus.barLens = np.asarray(barLens, dtype=np.float64)
+    corpus.chunks = None
+    return corpus
+
 class TrackDataSet:
     
-    def __init__(self,tracks):
-        rhythms = [None]*len(tracks)
-        melodies = [None]*len(tracks)
-        for i,t in enumerate(tracks):
-            rhythms[i] = rh.makeTrackRhythm(t)
-            melodies[i] = mel.makeTrackMelody(t,0)
-        (self.rhythmSamps,self.rhythmLens) = rh.makeRhythmSamples(rhythms)
-        self.rhythmTimesteps = [r.timesteps for r in rhythms]
-        self.melodyDS = mel.makeMelodyDataSet(melodies)
+    # tracks may be any iterable, including a generator that parses tracks
+    # lazily; see TrackCorpus for corpusDirectory. Alternatively a finished 
+    # corpus may be given in place of tracks.
+    def __init__(self, tracks=None, corpusDirectory=None, corpus=None):
+        if corpus is None:
+            corpus = TrackCorpus(corpusDirectory)
+            corpus.addStream(tracks)
+            corpus.finish()
+        self.corpus = corpus
+        self.rhythmSamps = corpus.rhythms.reshape(-1,1)
+        self.rhythmLens = corpus.trackLengths
+        self.rhythmTimesteps = corpus.trackSlices('rhythms')
+        self.melodyDS = mel.makeCorpusDataSet(corpus.pitches, corpus.newNotes, corpus.trackOffsets)
         
+class TrackSession:
+    """Follows a track as bars are added to it, keeping the HMM state after 
+    its rhythm (a rhythm_hmm.RhythmHMMSession) and the network state after 
+    its melody (a todd_ann.MelodySession), so that generating each bar only 
+    processes the bars added since the last one."""
+
+    def __init__(self, rhythm, melody):
+        self.rhythm = rhythm
+        self.melody = melody
+
+    # Extends the melody session with the part of a melody it has not seen
+    def catchUpMelody(self, melody):
+        if self.melody.length > melody.length():
+            raise ValueError('Session has seen {} timesteps, but the melody has only {}'.format(
+                self.melody.length, melody.length()))
+        self.melody.extend(melody.pitches[self.melody.length:],
+                           melody.newNotes[self.melody.length:])
+
+    # Returns the session as a dict of plain values that can be saved as JSON
+    # and passed to MelodyGenerator.restoreSession
+    def getState(self):
+        return {'rhythm': self.rhythm.getState(), 'melody': self.melody.getState()}
+
 class MelodyGenerator:
     
     def __init__(self, stateCount, layerSize, barLen, barCount, clusterCount, hmmIters=1000, octave=5):
@@ -38,87 +168,167 @@ class MelodyGenerator:
         self.barCount = barCount
         self.octave = octave
         
-    def train(self, epochs, tracks):
+    def train(self, epochs, tracks, nJobs=1):
         trackDS = TrackDataSet(tracks)
         mel.trainNetwork(self.net, trackDS.melodyDS, epochs)
-        bestHMM = self.hmm
-        bestScore = 0
-        for i in range(20):
-            nextHMM = deepcopy(self.hmm)
-            nextHMM.fit(trackDS.rhythmSamps, trackDS.rhythmLens)
-            nextScore = nextHMM.score(trackDS.rhythmSamps, trackDS.rhythmLens)
-            if nextScore > bestScore:
-                bestHMM = nextHMM
-                bestScore = nextScore
-        self.rdm.train(trackDS.rhythmTimesteps)
+        (bestHMM, _) = rh.fitHMMRestarts(self.hmm, trackDS.rhythmSamps,
+                                         trackDS.rhythmLens, 20, nJobs=nJobs)
+        self.rdm.train(trackDS.rhythmTimesteps, nJobs=nJobs)
         self.hmm = bestHMM
         
-    def trainTimed(self, epochs, ds):
+    # pruneMargin lets rh.fitHMMRestarts abandon HMM restarts that trail the 
+    # others, which saves time but can lose a slow starting restart that 
+    # would have ended best
+    def trainTimed(self, epochs, ds, nJobs=1, pruneMargin=None):
         start = time.clock()
-        self.rdm.train(ds.rhythmTimesteps)
+        self.rdm.train(ds.rhythmTimesteps, nJobs=nJobs)
         rdm = time.clock()
         print('RDM: {}'.format(rdm-start))
         mel.trainNetwork(self.net, ds.melodyDS, epochs)
         net = time.clock()
         print('Net: {}'.format(net-rdm))
-        bestHMM = self.hmm
-        bestScore = -np.inf
-        bestI = -1
-        for i in range(10):
-            nextHMM = deepcopy(self.hmm)
-            nextHMM.fit(ds.rhythmSamps, ds.rhythmLens)
-            nextScore = nextHMM.score(ds.rhythmSamps, ds.rhythmLens)
-            # print('Score {}: {}'.format(i,nextScore))
-            if nextScore > bestScore:
-                bestHMM = nextHMM
-                bestScore = nextScore
-                bestI = i
+        (bestHMM, restarts) = rh.fitHMMRestarts(self.hmm, ds.rhythmSamps, ds.rhythmLens,
+                                                10, nJobs=nJobs, pruneMargin=pruneMargin)
+        for (i, score, seconds, pruned) in restarts:
+            print('Restart {}: {} ({}){}'.format(i, score, seconds, ' pruned' if pruned else ''))
         self.hmm = bestHMM
         hmm = time.clock()
         print('RDM: {}'.format(rdm-start))
         print('Net: {}'.format(net-rdm))
         print('HMM: {}'.format(hmm-net))
         print('Total: {}'.format(hmm-start))
-        # print('Best: {} : {}'.format(bestI,bestScore))
     
     # Returns the original track + a generated bar
-    def generateBar(self, track, rdmLam=4.0):
+    def generateBar(self, track, rdmLam=4.0, seed=None, session=None):
+        return self.generateBars([track], rdmLam, None if seed is None else [seed],
+                                 None if session is None else [session])[0]
+    
+    # Returns each of a set of tracks + a generated bar, generating the bars 
+    # together as a batch. Each result is the same as generateBar would give 
+    # for that track alone; seeds optionally gives a random seed for each 
+    # track, and otherwise the tracks use the global random state in order.
+    # sessions optionally gives a TrackSession (see makeSession) following 
+    # each track, so that neither the HMM nor the network reruns over the 
+    # whole track for every bar. A session behind its track catches up with 
+    # the rest of the track, and is not extended with the generated bar.
+    def generateBars(self, tracks, rdmLam=4.0, seeds=None, sessions=None):
         # Format data for prediction
-        rhythm = rh.makeTrackRhythm(track)
-        (rhythmSamps,_) = rh.makeRhythmSamples([rhythm])
-        melody = mel.makeTrackMelody(track,0)
-        melodyDS = mel.makeMelodyDataSet([melody])
+        rhythms = [rh.makeTrackRhythm(t) for t in tracks]
+        melodies = [mel.makeTrackMelody(t) for t in tracks]
         # Generate notes
-        rhythmOutTS = lrd.generateNextBar(self.rdm, self.hmm, rdmLam, rhythmSamps)
-        #self.net.reset()
-        #for sample in melodyDS.getSequenceIterator(0):
-        #    self.net.activate(sample[0])
-        #Whatever
-        pitchOutTS = mel.getNextPitches(self.net, melody.pitches[-1], melodyDS,
-                                        rhythm.timesteps[-1], rhythmOutTS)
+        rhythmOut = lrd.generateNextBars(self.rdm, self.hmm, rdmLam,
+                                         [rh.makeRhythmSamples([r])[0] for r in rhythms], seeds,
+                                         None if sessions is None else [s.rhythm for s in sessions])
+        startPitches = [m.pitches[-1] for m in melodies]
+        if sessions is None:
+            pitchOut = mel.getNextPitchesBatch(self.net, startPitches,
+                                               [mel.makeMelodyInputs(m) for m in melodies], rhythmOut)
+        else:
+            for (session, melody) in zip(sessions, melodies):
+                session.catchUpMelody(melody)
+            pitchOut = mel.getNextPitchesBatch(self.net, startPitches, None, rhythmOut,
+                                               [s.melody.inputState() for s in sessions])
         # Load output into classes
-        t = 0
-        for t in range(len(rhythmOutTS)):
-            rhythm.addTimestep(rhythmOutTS[t])
-            newNote = (rhythmOutTS[t] == 1)
-            melody.addNote(pitchOutTS[t],newNote)
-        trackOut = makeTrackFromRhythmMelody(rhythm, melody, self.octave)
-        return trackOut
+        tracksOut = []
+        for (track, rhythm, melody, rhythmOutTS, pitchOutTS) in zip(tracks, rhythms, melodies,
+                                                                   rhythmOut, pitchOut):
+            rhythm.extend(rhythmOutTS)
+            for t in range(len(rhythmOutTS)):
+                newNote = (rhythmOutTS[t] == 1)
+                melody.addNote(int(pitchOutTS[t]),newNote)
+            trackOut = makeTrackFromRhythmMelody(rhythm, melody, self.octave)
+            trackOut.barLen = track.barLen
+            # The track runs to the end of the new bar even if it ends in a rest
+            trackOut.length = rhythm.length()
+            tracksOut.append(trackOut)
+        return tracksOut
 
-    # Saves the melody generator's learned characteristics to a file to be loaded later        
+    # Starts a session following a track as it is extended
+    def makeSession(self, track=None):
+        session = TrackSession(rh.RhythmHMMSession(self.hmm), mel.MelodySession(self.net))
+        if not track is None:
+            session.rhythm.extend(rh.makeTrackRhythm(track).timesteps)
+            session.catchUpMelody(mel.makeTrackMelody(track))
+        return session
+
+    # Recreates a session saved by TrackSession.getState, raising ValueError 
+    # if it was saved with a different model
+    def restoreSession(self, state):
+        return TrackSession(rh.restoreRhythmHMMSession(self.hmm, state['rhythm']),
+                            mel.restoreMelodySession(self.net, state['melody']))
+
+    # Saves the melody generator's learned characteristics to a file to be loaded later.
+    # Files ending in .npz use the versioned format of model_format, and other
+    # files are pickled
     def save(self, filename):
+        if filename.endswith('.npz'):
+            saveMelodyGeneratorArrays(self, filename)
+            return
         file = open(filename, "wb")
         pickle.dump(self, file)
         file.close()
         
 def loadMelodyGenerator(filename):
+    if filename.endswith('.npz'):
+        return loadMelodyGeneratorArrays(filename)
     file = open(filename, 'rb')
     mg = pickle.load(file)
     file.close()
     mg.net.sorted = False
     mg.net.sortModules()
+    mg.rdm.buildLogProbTable()
+    return mg
+
+def saveMelodyGeneratorArrays(mg, filename):
+    arrays = {'stateCount': mg.stateCount,
+              'barLen': mg.barLen,
+              'barCount': mg.barCount,
+              'octave': mg.octave,
+              'hmm_startprob': mg.hmm.startprob_,
+              'hmm_transmat': mg.hmm.transmat_,
+              'hmm_emissionprob': mg.hmm.emissionprob_,
+              'hmm_n_iter': mg.hmm.n_iter,
+              'hmm_tol': mg.hmm.tol,
+              'rdm_weights': mg.rdm.weights,
+              'rdm_probs': mg.rdm.probs,
+              'rdm_converged': mg.rdm.converged}
+    if not mg.rdm.partitions is None:
+        arrays['rdm_partitions'] = mg.rdm.partitions
+    arrays.update(model_format.networkArrays(mg.net))
+    model_format.saveModel(filename, 'rhythm_melody', arrays)
+
+def loadMelodyGeneratorArrays(filename):
+    arrays = model_format.loadModel(filename, 'rhythm_melody')
+    mg = MelodyGenerator(int(arrays['stateCount']), arrays['net_inWeights'].shape[0],
+                         int(arrays['barLen']), int(arrays['barCount']),
+                         arrays['rdm_weights'].shape[2], int(arrays['hmm_n_iter']),
+                         int(arrays['octave']))
+    mg.net = model_format.restoreNetwork(arrays, mel.buildToddNetwork)
+    mg.hmm.tol = float(arrays['hmm_tol'])
+    mg.hmm.startprob_ = arrays['hmm_startprob']
+    mg.hmm.transmat_ = arrays['hmm_transmat']
+    mg.hmm.emissionprob_ = arrays['hmm_emissionprob']
+    mg.rdm.weights = arrays['rdm_weights']
+    mg.rdm.probs = arrays['rdm_probs']
+    mg.rdm.converged = bool(arrays['rdm_converged'])
+    mg.rdm.partitions = arrays.get('rdm_partitions')
+    mg.rdm.buildLogProbTable()
     return mg
 
+# Converts a pickled melody generator to the versioned format, saved to 
+# npzPath or, by default, beside the pickle. Generators pickled before 
+# barLen, barCount and octave were stored take them from the RDM and the 
+# default octave.
+def convertMelodyGenerator(pklPath, npzPath=None):
+    if npzPath is None:
+        npzPath = os.path.splitext(pklPath)[0] + '.npz'
+    mg = loadMelodyGenerator(pklPath)
+    for (name, value) in (('barLen', mg.rdm.barLen), ('barCount', mg.rdm.barCount), ('octave', 5)):
+        if not hasattr(mg, name):
+            setattr(mg, name, value)
+    saveMelodyGeneratorArrays(mg, npzPath)
+    return npzPath
+
 def makeTrackFromRhythmMelody(rhythm, melody, octave):
     assert rhythm.length() == melody.length(), "Rhythm and melody must have equal lengths"
     track = midi.Track()
@@ -7,11 +7,14 @@ from pybrain.structure.connections.connection import Connection
 from pybrain.structure import LinearLayer, SigmoidLayer
 from pybrain.structure import RecurrentNetwork
 from pybrain.structure import FullConnection, IdentityConnection
-from pybrain.datasets.sequential import SequentialDataSet
 from pybrain.supervised.trainers import BackpropTrainer
+from pybrain.tools.functions import sigmoid
+from scipy.signal import lfilter
 from scipy import dot
-import operator
+import numpy as np
+import hashlib
 import midi
+import network_training
 
 class WeightedPartialIdentityConnection(Connection):
     """Connection which connects the i'th element from the first module's 
@@ -49,23 +52,26 @@ def outputSize():
     return pitchCount
 
 def makeNoteSample(pitch, newNote):
-    sample = [0] * sampleSize()
-    for i in range(pitchCount):
-        if i == pitch:
-            sample[i] = 1
-        else:
-            sample[i] = 0
-    sample[pitchCount] = newNote
-    return sample
+    return makeNoteSamples([pitch], [newNote])[0]
     
+# Array version of makeNoteSample, making one sample per row
+def makeNoteSamples(pitches, newNotes):
+    pitches = np.asarray(pitches)
+    samples = np.zeros((len(pitches), sampleSize()))
+    hasPitch = (pitches >= 0) & (pitches < pitchCount)
+    samples[np.nonzero(hasPitch)[0], pitches[hasPitch]] = 1
+    samples[:,pitchCount] = newNotes
+    return samples
+
 def makeNoteTarget(pitch):
-    target = [0] * outputSize()
-    for i in range(pitchCount):
-        if i == pitch:
-            target[i] = 1
-        else:
-            target[i] = 0
-    return target
+    return makeNoteTargets([pitch])[0]
+
+def makeNoteTargets(pitches):
+    pitches = np.asarray(pitches)
+    targets = np.zeros((len(pitches), outputSize()))
+    hasPitch = (pitches >= 0) & (pitches < pitchCount)
+    targets[np.nonzero(hasPitch)[0], pitches[hasPitch]] = 1
+    return targets
 
 class Melody():
     def __init__(self):
@@ -86,36 +92,54 @@ class Melody():
         return len(self.pitches)
 
 def makeTrackMelody(track):
-    assert track.isMonophonic(), "Only monophonic tracks can be enscribed"
     melody = Melody()
-    melody.pitches = [nonPitch]*track.length
-    melody.newNotes = [False]*track.length
-    noteStart = 0
-    noteEnd = 0
-    n = -1
-    for t in range(track.length):
-        if noteEnd <= t:
-            n = n + 1
-            noteStart = track.notes[n].start
-            noteEnd = track.notes[n].start + track.notes[n].duration
-        if t == noteStart:
-            melody.newNotes[t] = True
-        if noteStart <= t and t < noteEnd:
-            melody.pitches[t] = track.notes[n].pitch % pitchCount
+    (rhythm, pitches) = midi.rasterizeTrack(track)
+    melody.pitches = np.where(pitches >= 0, pitches % pitchCount, nonPitch).tolist()
+    melody.newNotes = (rhythm == 1).tolist()
     return melody
 
+# Returns the network inputs of a melody's samples, as added by addSamples
+def makeMelodyInputs(melody):
+    pitches = np.asarray(melody.pitches)
+    changes = np.nonzero(pitches[:-1] != pitches[1:])[0]
+    return makeNoteSamples(pitches[changes], np.asarray(melody.newNotes)[changes])
+
 def makeMelodyDataSet(melodies):
-    seqDataSet = SequentialDataSet(sampleSize(), outputSize())
-    for m in melodies:
-        seqDataSet.newSequence()
-        m.addSamples(seqDataSet)
-    return seqDataSet
+    melodies = list(melodies)
+    lengths = [len(m.pitches) for m in melodies]
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    join = lambda arrays: np.concatenate([np.asarray(a, dtype=np.int64) for a in arrays] +
+                                         [np.zeros(0, dtype=np.int64)])
+    return makeCorpusDataSet(join(m.pitches for m in melodies),
+                             join(m.newNotes for m in melodies), offsets)
 
-def buildToddNetwork(hiddenSize):
+# Builds the dataset of makeMelodyDataSet from the concatenated pitches and
+# new note flags of a set of melodies, where offsets gives the start of each
+# melody followed by the total length, as in a TrackCorpus. Every sample is
+# encoded in one pass: as in Melody.addSamples, there is a sample for each 
+# timestep whose pitch differs from the next one in the same melody. 
+# Melodies without any samples are left out.
+def makeCorpusDataSet(pitches, newNotes, offsets):
+    pitches = np.asarray(pitches, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    changes = np.zeros(len(pitches), dtype=bool)
+    changes[:-1] = pitches[:-1] != pitches[1:]
+    # The last timestep of a melody is compared with the next melody
+    ends = offsets[1:][offsets[1:] > offsets[:-1]]
+    changes[ends-1] = False
+    sampleSteps = np.nonzero(changes)[0]
+    inputs = makeNoteSamples(pitches[sampleSteps], np.asarray(newNotes)[sampleSteps])
+    targets = makeNoteTargets(pitches[sampleSteps+1])
+    lengths = np.diff(np.searchsorted(sampleSteps, offsets))
+    return network_training.makeSequentialDataSet(inputs, targets, lengths)
+
+# inSize and outSize default to the current sample and output sizes, and are
+# only given to rebuild networks saved with other layer sizes
+def buildToddNetwork(hiddenSize, inSize=None, outSize=None):
     net = RecurrentNetwork()
-    inLayer = LinearLayer(sampleSize())
+    inLayer = LinearLayer(sampleSize() if inSize is None else inSize)
     hiddenLayer = SigmoidLayer(hiddenSize)
-    outLayer = SigmoidLayer(outputSize())
+    outLayer = SigmoidLayer(outputSize() if outSize is None else outSize)
     net.addInputModule(inLayer)
     net.addModule(hiddenLayer)
     net.addOutputModule(outLayer)
@@ -128,29 +152,185 @@ def buildToddNetwork(hiddenSize):
     net.sortModules()
     return net
     
-def trainNetwork(net, ds, epochs, momentum=0.4, weightdecay = 0.01):
-    trainer = BackpropTrainer(net, dataset=ds, momentum=momentum, weightdecay=weightdecay)
-    trainer.trainEpochs(epochs)
+class ToddEngine:
+    """Runs a trained network built by buildToddNetwork with plain NumPy 
+    operations, computing exactly what the pybrain network would: the input 
+    layer adds the weighted previous input to each new sample, and the 
+    hidden and output layers are sigmoids of the full connections into them."""
+
+    def __init__(self, net):
+        inLayer = net.inmodules[0]
+        outLayer = net.outmodules[0]
+        inToHidden = [c for c in net.connections[inLayer] if isinstance(c, FullConnection)][0]
+        hiddenToOut = [c for c in net.connections[inToHidden.outmod] if c.outmod is outLayer][0]
+        self.inWeights = inToHidden.params.reshape(inToHidden.outdim, inToHidden.indim)
+        self.outWeights = hiddenToOut.params.reshape(hiddenToOut.outdim, hiddenToOut.indim)
+        self.feedback = net.recurrentConns[0].weight
+        self.reset()
+
+    def reset(self):
+        self.inputState = np.zeros(self.inWeights.shape[1])
+
+    # Feeds a sequence of samples through the input recurrence without 
+    # computing outputs, as when activating the network on a history
+    def warmUp(self, samples):
+        samples = np.asarray(samples, dtype=np.float64)
+        if len(samples) > 0:
+            (states, _) = lfilter([1.0], [1.0, -self.feedback], samples, axis=0,
+                                  zi=self.feedback*self.inputState[None,:])
+            self.inputState = states[-1]
+
+    def activate(self, sample):
+        self.inputState = sample + self.feedback*self.inputState
+        hidden = sigmoid(np.dot(self.inWeights, self.inputState))
+        return sigmoid(np.dot(self.outWeights, hidden))
+
+    # Warms up a batch of independent copies of the network, one for each
+    # sequence of samples, after which activateRows advances any of them.
+    # Sequences are left padded with empty samples, which leave a reset
+    # network's state unchanged.
+    def warmUpBatch(self, sequences):
+        longest = max([len(s) for s in sequences] + [0])
+        padded = np.zeros((len(sequences), longest, self.inWeights.shape[1]))
+        for (b, sequence) in enumerate(sequences):
+            if len(sequence) > 0:
+                padded[b,longest-len(sequence):] = sequence
+        self.inputState = np.zeros((len(sequences), self.inWeights.shape[1]))
+        if longest > 0:
+            self.inputState = lfilter([1.0], [1.0, -self.feedback], padded, axis=1)[:,-1]
+
+    # Activates the given rows of a batch with one sample each. Uses einsum,
+    # so each row's output does not depend on the rest of the batch.
+    def activateRows(self, samples, rows):
+        self.inputState[rows] = samples + self.feedback*self.inputState[rows]
+        hidden = sigmoid(np.einsum('bi,hi->bh', self.inputState[rows], self.inWeights))
+        return sigmoid(np.einsum('bh,oh->bo', hidden, self.outWeights))
+
+class MelodySession:
+    """The input state of a Todd network after the samples of a melody, as 
+    warmUp leaves it, kept so that the melody can be extended without feeding
+    it through again. length is the number of timesteps seen; a timestep's 
+    sample depends on the next pitch, so the last timestep's pitch and new 
+    note flag are kept until the next one arrives."""
+
+    def __init__(self, net, melody=None):
+        self.engine = ToddEngine(net)
+        self.length = 0
+        self.lastPitch = None
+        self.lastNewNote = None
+        if not melody is None:
+            self.extend(melody.pitches, melody.newNotes)
+
+    # Feeds the samples of a further stretch of the melody into the state
+    def extend(self, pitches, newNotes):
+        pitches = np.asarray(pitches, dtype=np.int64).reshape(-1)
+        newNotes = np.asarray(newNotes).reshape(-1)
+        if len(pitches) == 0:
+            return
+        length = len(pitches)
+        if self.length > 0:
+            pitches = np.concatenate([[self.lastPitch], pitches])
+            newNotes = np.concatenate([[self.lastNewNote], newNotes])
+        changes = np.nonzero(pitches[:-1] != pitches[1:])[0]
+        self.engine.warmUp(makeNoteSamples(pitches[changes], newNotes[changes]))
+        self.lastPitch = int(pitches[-1])
+        self.lastNewNote = bool(newNotes[-1])
+        self.length += length
+
+    def inputState(self):
+        return self.engine.inputState.copy()
+
+    # Returns the session as a dict of plain values that can be saved as JSON
+    # and passed to restoreMelodySession
+    def getState(self):
+        return {'fingerprint': engineFingerprint(self.engine),
+                'length': int(self.length),
+                'lastPitch': self.lastPitch,
+                'lastNewNote': self.lastNewNote,
+                'inputState': self.engine.inputState.tolist()}
+
+# Recreates a session saved by getState, raising ValueError if the state was
+# saved with a different network
+def restoreMelodySession(net, state):
+    session = MelodySession(net)
+    if state['fingerprint'] != engineFingerprint(session.engine):
+        raise ValueError('Session was saved with a different network')
+    session.length = state['length']
+    session.lastPitch = state['lastPitch']
+    session.lastNewNote = state['lastNewNote']
+    session.engine.inputState = np.array(state['inputState'], dtype=np.float64)
+    return session
+
+# Hashes a network's weights, identifying the model a session belongs to
+def engineFingerprint(engine):
+    digest = hashlib.sha1()
+    for params in (engine.inWeights, engine.outWeights, np.array(engine.feedback)):
+        params = np.ascontiguousarray(params, dtype=np.float64)
+        digest.update(str(params.shape).encode('utf-8'))
+        digest.update(params.tobytes())
+    return digest.hexdigest()
+
+# backend is 'numpy' to train with network_training, which is much faster 
+# and takes batchSize (see network_training.trainNetwork), or 'pybrain' to 
+# use pybrain's BackpropTrainer
+def trainNetwork(net, ds, epochs, momentum=0.4, weightdecay = 0.01, backend='numpy', batchSize=1):
+    if backend == 'numpy':
+        network_training.trainNetwork(net, ds, epochs, momentum=momentum,
+                                      weightdecay=weightdecay, batchSize=batchSize)
+    else:
+        trainer = BackpropTrainer(net, dataset=ds, momentum=momentum, weightdecay=weightdecay)
+        trainer.trainEpochs(epochs)
     
+# net may be a network built by buildToddNetwork or a ToddEngine made from one
 def getNextPitches(net, startPitch, pitchesDS, startBeat, beats):
+    engine = net if isinstance(net, ToddEngine) else ToddEngine(net)
     noteCount = len(beats)
     notes = [0]*noteCount
-    net.reset()
-    for sample in pitchesDS.getSequenceIterator(0):
-        net.activate(sample[0])
+    engine.reset()
+    if pitchesDS.getNumSequences() > 0:
+        engine.warmUp(pitchesDS.getSequence(0)[0])
     lastPitch = startPitch
     for i in range(noteCount):
         # If a new note is being played, change the pitch
         if beats[i] == 1:
             nextSample = makeNoteSample(lastPitch,1)
-            out = net.activate(nextSample)
-            lastPitch = max(enumerate(out),key=operator.itemgetter(1))[0]
+            out = engine.activate(nextSample)
+            lastPitch = int(np.argmax(out))
         # If the melody is silent, use no note
         elif beats[i] == 0:
             if lastPitch != nonPitch:
                 nextSample = makeNoteSample(nonPitch,0)
-                net.activate(nextSample)
+                engine.activate(nextSample)
             lastPitch = nonPitch
         notes[i] = lastPitch
     return notes
         
+
+# Batched version of getNextPitches for a set of melodies, with startPitches,
+# the input histories (see makeMelodyInputs) and the beats of each indexed by
+# [melody, ...]. Returns the pitches as a (melodies, beats) array. 
+# startStates optionally gives each melody's input state after its history,
+# such as MelodySession.inputState, in place of histories.
+def getNextPitchesBatch(net, startPitches, histories, beats, startStates=None):
+    engine = net if isinstance(net, ToddEngine) else ToddEngine(net)
+    beats = np.asarray(beats).reshape(len(startPitches), -1)
+    notes = np.zeros(beats.shape, dtype=int)
+    if startStates is None:
+        engine.warmUpBatch(histories)
+    else:
+        engine.inputState = np.array(startStates, dtype=np.float64).reshape(len(startPitches), -1)
+    lastPitches = np.array(startPitches, dtype=int)
+    for i in range(beats.shape[1]):
+        # New notes change the pitch, and silences activate the network with
+        # no note unless the melody was already silent
+        starting = beats[:,i] == 1
+        silencing = (beats[:,i] == 0) & (lastPitches != nonPitch)
+        rows = np.nonzero(starting | silencing)[0]
+        if len(rows) > 0:
+            samples = makeNoteSamples(np.where(starting[rows], lastPitches[rows], nonPitch),
+                                      starting[rows].astype(int))
+            out = engine.activateRows(samples, rows)
+            lastPitches[rows[starting[rows]]] = np.argmax(out[starting[rows]], axis=1)
+        lastPitches[beats[:,i] == 0] = nonPitch
+        notes[:,i] = lastPitches
+    return notes